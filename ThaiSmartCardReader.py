@@ -18,7 +18,7 @@
 from smartcard.System import readers
 from smartcard.CardType import AnyCardType
 from smartcard.CardRequest import CardRequest
-from smartcard.Exceptions import NoCardException
+from smartcard.Exceptions import NoCardException, CardRequestTimeoutException
 from smartcard.util import toHexString
 from smartcard.scard import SCARD_PROTOCOL_T0, SCARD_PROTOCOL_T1, SCARD_SHARE_SHARED
 import subprocess
@@ -26,7 +26,18 @@ import time
 import asyncio
 import json
 import threading
+import multiprocessing
 import os
+import csv
+import socket
+import sqlite3
+import hashlib
+import hmac
+import random
+import re
+import datetime
+from collections import deque, OrderedDict
+from queue import Queue, Empty, Full
 from websockets import serve
 import base64
 import pystray
@@ -38,6 +49,10 @@ try:
     from win10toast import ToastNotifier
 except Exception:
     ToastNotifier = None
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except Exception:
+    AESGCM = None
 
 
 MESSAGE_VERSION = "1.0"
@@ -55,6 +70,22 @@ class IDCardReader:
         # Per-field retry count
         self.field_retries = int(os.environ.get('SMARTCARD_FIELD_RETRIES', '2'))
         # Global read attempts already handled outside (3). Here we just refine per field.
+        # Batch enrolment: results are handed to BatchPipeline, polling is tightened
+        self.batch_pipeline = None
+        batch = os.environ.get('BATCH_MODE', '0') == '1'
+        self.insert_poll_interval = float(os.environ.get('INSERT_POLL_INTERVAL', '0.05' if batch else '0.3'))
+        self.removal_poll_interval = float(os.environ.get('REMOVAL_POLL_INTERVAL', '0.1' if batch else '0.5'))
+        self._last_removed_at = None
+        # Short-TTL encrypted cache for cards pulled and reinserted (CARD_CACHE=1)
+        self.card_cache = CardCache.from_env()
+        self.last_read_cached = False
+        # Per-reader health (backoff, protocol/chunk selection); set by run_events for the active reader
+        self.health = None
+        self.health_by_reader = {}
+        self.read_attempts = int(os.environ.get('SMARTCARD_READ_ATTEMPTS', '3'))
+        self.last_read_attempts = 0
+        # Stamped on every run_events loop iteration; shard workers use it to detect a hung driver call
+        self.alive_at = time.monotonic()
 
     # ------------------- Helper Functions -------------------
     def decode_text(self, data):
@@ -75,6 +106,8 @@ class IDCardReader:
     def apdu_retry(self, connection, apdu, retries):
         """Retry APDU on communication errors."""
         last_err = None
+        if self.health:
+            self.health.apdus += 1
         for i in range(1, retries + 2):  # initial try + retries
             try:
                 resp, sw1, sw2 = self.send_apdu_with_get_response(connection, apdu)
@@ -82,12 +115,12 @@ class IDCardReader:
                     print(f"[DEBUG] APDU #{i} -> SW={sw1:02X} {sw2:02X} len={len(resp)}")
                 return resp, sw1, sw2
             except Exception as e:
-                msg = str(e)
                 last_err = e
+                code = classify_error(e)
                 if self.debug:
-                    print(f"[DEBUG] APDU error try {i}: {msg}")
-                if '0x8010002F' in msg or 'communications error' in msg.lower():
-                    time.sleep(0.15)
+                    print(f"[DEBUG] APDU error try {i}: {code} {e}")
+                if code in TRANSIENT_ERRORS and i <= retries:
+                    time.sleep(self.health.apdu_delay(i) if self.health else backoff_delay(i, 0.05, 1.0))
                     continue
                 else:
                     break
@@ -95,34 +128,32 @@ class IDCardReader:
 
     def parse_thai_date(self, date_str):
         """แปลงวันที่จากรูปแบบ YYYYMMDD เป็นรูปแบบที่อ่านง่าย"""
-        if date_str == '99999999':
-            return "ตลอดชีพ", "LIFELONG"
-            
-        if len(date_str) == 8 and date_str.isdigit():
-            try:
-                year = date_str[0:4]
-                month = date_str[4:6]
-                day = date_str[6:8]
-                
-                thai_year = int(year)
-                eng_year = thai_year - 543
-                
-                thai_months = ['', 'มกราคม', 'กุมภาพันธ์', 'มีนาคม', 'เมษายน', 'พฤษภาคม', 'มิถุนายน',
-                            'กรกฎาคม', 'สิงหาคม', 'กันยายน', 'ตุลาคม', 'พฤศจิกายน', 'ธันวาคม']
-                
-                eng_months = ['', 'January', 'February', 'March', 'April', 'May', 'June',
-                            'July', 'August', 'September', 'October', 'November', 'December']
-                
-                month_int = int(month)
-                if 1 <= month_int <= 12:
-                    thai_date = f"{int(day)} {thai_months[month_int]} {thai_year}"
-                    eng_date = f"{int(day)} {eng_months[month_int]} {eng_year}"
-                    return thai_date, eng_date
-            except Exception as e:
-                print(f"[ผิดพลาด] แปลงวันที่ไม่สำเร็จ: {e}")
-                return "ไม่ระบุ", "Not specified"
-        else:
-            return "ไม่ระบุ", "Not specified"
+        return parse_thai_date(date_str)
+
+    def connect_card(self, connection, protocol: int) -> int:
+        """เชื่อมต่อด้วย protocol ที่จำไว้ หากบัตรไม่รองรับ (SCARD_E_PROTO_MISMATCH) ใช้ T0|T1 ทันที
+
+        คืน protocol ที่ใช้เชื่อมต่อจริง; การ fallback ไม่นับเป็นการอ่านที่ล้มเหลว
+        ไม่ลบ protocol ที่จำไว้ เพราะยังไม่ทราบ ATR ของบัตรนี้ (read_record จะจำค่าที่เจรจาได้ให้ ATR ปัจจุบันเอง)
+        """
+        any_protocol = SCARD_PROTOCOL_T0 | SCARD_PROTOCOL_T1
+        try:
+            connection.connect(protocol=protocol, mode=SCARD_SHARE_SHARED)
+            return protocol
+        except Exception as e:
+            if protocol == any_protocol or classify_error(e) != 'SCARD_E_PROTO_MISMATCH':
+                raise
+            if self.debug:
+                print(f"[DEBUG] Protocol {PROTOCOL_NAMES.get(protocol)} not supported, falling back to T0|T1")
+        connection.connect(protocol=any_protocol, mode=SCARD_SHARE_SHARED)
+        return any_protocol
+
+    def health_for(self, reader_name: str) -> 'ReaderHealth':
+        """คืน ReaderHealth ของเครื่องอ่าน (สร้างใหม่หากยังไม่มี)"""
+        health = self.health_by_reader.get(reader_name)
+        if health is None:
+            health = self.health_by_reader[reader_name] = ReaderHealth.from_env(reader_name)
+        return health
 
     def disconnect_card(self):
         """ตัดการเชื่อมต่อจากบัตร"""
@@ -164,19 +195,34 @@ class IDCardReader:
 
     # ------------------- Read ID Card -------------------
     def read_card_data(self, cardservice):
-        """อ่านข้อมูลและคืนค่า dict แทนการพิมพ์"""
-        data = {}
+        """อ่านข้อมูลและคืนค่า dict แทนการพิมพ์ (รูปแบบเดียวกับ data ใน card_data)"""
+        return self.read_record(cardservice).to_dict()
+
+    def read_record(self, cardservice) -> 'CardRecord':
+        """อ่านข้อมูลบัตรและคืน CardRecord (ข้อมูลดิบ + รูปเป็น bytes; ฟิลด์ที่แปลงแล้วคำนวณเมื่อเรียกใช้)"""
         try:
-            cardservice.connection.connect(
-                protocol=SCARD_PROTOCOL_T0 | SCARD_PROTOCOL_T1,
-                mode=SCARD_SHARE_SHARED
-            )
-            atr = cardservice.connection.getATR()
-            data['atr'] = toHexString(atr)
+            # protocol ที่บัตรล่าสุดบนเครื่องอ่านนี้เจรจาได้ (ค่าเริ่มต้น T0|T1)
+            any_protocol = SCARD_PROTOCOL_T0 | SCARD_PROTOCOL_T1
+            protocol = self.health.protocol() if self.health else any_protocol
+            protocol = self.connect_card(cardservice.connection, protocol)
+            atr = toHexString(cardservice.connection.getATR())
+            if self.health:
+                wanted = self.health.protocol(atr)
+                if protocol != any_protocol and wanted != protocol:
+                    # บัตรรุ่นนี้เจรจา protocol อื่นได้ -> เชื่อมต่อใหม่ด้วย protocol นั้น
+                    cardservice.connection.disconnect()
+                    protocol = self.connect_card(cardservice.connection, wanted)
+                if protocol == any_protocol:
+                    # จำ protocol ที่เจรจาได้จริงต่อรุ่นเครื่องอ่าน + ATR
+                    try:
+                        self.health.remember_protocol(atr, cardservice.connection.getProtocol())
+                    except Exception:
+                        pass
+                self.health.last_atr = atr
             if self.debug:
-                print(f"[DEBUG] Connected ATR={data['atr']}")
+                print(f"[DEBUG] Connected ATR={atr} protocol={protocol}")
         except Exception as e:
-            raise RuntimeError(f"ไม่สามารถเชื่อมต่อบัตร: {e}")
+            raise RuntimeError(f"ไม่สามารถเชื่อมต่อบัตร: {e}") from e
 
         SELECT = [0x00, 0xA4, 0x04, 0x00, 0x08]
         THAI_ID_CARD = [0xA0, 0x00, 0x00, 0x00, 0x54, 0x48, 0x00, 0x01]
@@ -189,12 +235,6 @@ class IDCardReader:
         if self.debug:
             print(f"[DEBUG] Applet selected SW={sw1:02X} {sw2:02X}")
 
-        # Settle delay before heavy reads
-        if self.settle_delay > 0:
-            time.sleep(self.settle_delay)
-            if self.debug:
-                print(f"[DEBUG] Settled for {self.settle_delay}s before field reads")
-
         commands = {
             'cid': [0x80, 0xb0, 0x00, 0x04, 0x02, 0x00, 0x0d],
             'name_th': [0x80, 0xb0, 0x00, 0x11, 0x02, 0x00, 0x64],
@@ -208,114 +248,65 @@ class IDCardReader:
             'request_number': [0x80, 0xB0, 0x16, 0x19, 0x02, 0x00, 0x0E]
         }
 
-        def read_field(key):
+        def read_field(key, require_ok=False):
             apdu = commands[key]
             resp, sw1_, sw2_ = self.apdu_retry(cardservice.connection, apdu, self.field_retries)
+            if require_ok and (sw1_, sw2_) != (0x90, 0x00):
+                if self.debug:
+                    print(f"[DEBUG] Field {key} SW={sw1_:02X} {sw2_:02X}")
+                return None
             txt = self.decode_text(resp)
             if self.debug:
                 print(f"[DEBUG] Field {key} -> '{txt}'")
             return txt
 
-        data['cid'] = read_field('cid')
-        full_name_th_raw = read_field('name_th').replace('#', ' ').strip()
-        full_name_en_raw = read_field('name_en').replace('#', ' ').strip()
-
-        def parse_thai_name(full):
-            parts = [p for p in full.split(' ') if p]
-            title = ''
-            first = ''
-            last = ''
-            thai_titles = {'จ.ต.','จ.ต.','จ.ท.','จ.ท.','จ.ส.ต.','จ.ส.ต.','จ.ส.ท.','จ.ส.อ.','จ.อ.','จ.อ.','ด.ต.','น.ต.','น.ต. ...ร.น.','น.ท.','น.ท. ...ร.น.','น.อ.','น.อ. ...ร.น.','พ.จ.ต.','พ.จ.ท.','พ.จ.อ.','พ.ต.','พ.ต.ต.','พ.ต.ท.','พ.ต.อ.','พ.ท.','พ.อ.','พ.อ.ต.','พ.อ.ท.','พ.อ.อ.','พล.ต.','พล.ต.ต.','พล.ต.ท.','พล.ต.อ.','พล.ท.','พล.ร.ต.','พล.ร.ท.','พล.ร.อ.','พล.อ.','พล.อ.ต.','พล.อ.ท.','พล.อ.อ.','พลฯ','พลฯ','พลฯ','ม.ร.ว.','ม.ล.','ร.ต.','ร.ต.','ร.ต. ...ร.น.','ร.ต.ต.','ร.ต.ท.','ร.ต.อ.','ร.ท.','ร.ท.','ร.ท. ...ร.น.','ร.อ.','ร.อ.','ร.อ. ...ร.น.','ส.ต.','ส.ต.ต.','ส.ต.ท.','ส.ต.อ.','ส.ท.','ส.อ.','นาย','นาง','นางสาว','น.ส.','เด็กชาย','ด.ช.','เด็กหญิง','ด.ญ.'}
-            if parts:
-                if parts[0] in thai_titles:
-                    title = parts[0]
-                    remaining = parts[1:]
-                else:
-                    remaining = parts
-                if remaining:
-                    first = remaining[0]
-                if len(remaining) >= 2:
-                    last = remaining[-1]
-            return title, first, last
-
-        def parse_english_name(full):
-            parts = [p for p in full.split(' ') if p]
-            title = ''
-            first = ''
-            last = ''
-            english_titles = {'Mr.','Mrs.','Miss','Ms.','Master'}
-            if parts:
-                if parts[0] in english_titles:
-                    title = parts[0]
-                    remaining = parts[1:]
-                else:
-                    remaining = parts
-                if remaining:
-                    first = remaining[0]
-                if len(remaining) >= 2:
-                    last = remaining[-1]
-            return title, first, last
-
-        title_th, first_th, last_th = parse_thai_name(full_name_th_raw)
-        title_en, first_en, last_en = parse_english_name(full_name_en_raw)
-
-        data['full_name_th'] = full_name_th_raw
-        data['title_th'] = title_th
-        data['name_th'] = first_th
-        data['last_name_th'] = last_th
-        data['full_name_en'] = full_name_en_raw
-        data['title_en'] = title_en
-        data['name_en'] = first_en
-        data['last_name_en'] = last_en
-
-        birth_raw = read_field('birth')
-        birth_th, birth_en = self.parse_thai_date(birth_raw)
-        data['birth_raw'] = birth_raw
-        data['birth_th'] = birth_th
-        data['birth_en'] = birth_en
-
-        gender_code = read_field('gender')
-        gender_th = "ชาย" if gender_code == "1" else "หญิง" if gender_code == "2" else gender_code
-        gender_en = "Male" if gender_code == "1" else "Female" if gender_code == "2" else gender_code
-        data['gender_th'] = gender_th
-        data['gender_en'] = gender_en
-
-        issue_raw = read_field('issue_date')
-        issue_th, issue_en = self.parse_thai_date(issue_raw)
-        data['issue_date_raw'] = issue_raw
-        data['issue_date_th'] = issue_th
-        data['issue_date_en'] = issue_en
-
-        expire_raw = read_field('expire_date')
-        expire_th, expire_en = self.parse_thai_date(expire_raw)
-        data['expire_date_raw'] = expire_raw
-        data['expire_date_th'] = expire_th
-        data['expire_date_en'] = expire_en
-
-        issuer_name = read_field('issuer').strip()
-        data['issuer'] = issuer_name
-
-        address = read_field('address').replace('#', ' ').strip()
-        data['address'] = address
-        # Address parsing (Thai typical format)
-        import re
-        no_match = re.search(r'^(\d+)', address)
-        moo_match = re.search(r'หมู่(?:ที่)?\s*(\d+)', address)
-        tumbol_match = re.search(r'ตำบล([^\s]+)', address)
-        amphur_match = re.search(r'อำเภอ([^\s]+)', address)
-        province_match = re.search(r'จังหวัด([^\s]+)', address)
-        data['address_no'] = no_match.group(1) if no_match else ''
-        data['address_moo'] = moo_match.group(1) if moo_match else ''
-        data['address_tumbol'] = tumbol_match.group(1) if tumbol_match else ''
-        data['address_amphur'] = amphur_match.group(1) if amphur_match else ''
-        data['address_province'] = province_match.group(1) if province_match else ''
-
-        request_number = read_field('request_number').strip()
-        data['request_number'] = request_number
+        # ตรวจบัตรที่เพิ่งอ่านไป: อ่าน cid + request_number (2 APDU) ก่อน settle delay
+        # บัตรอาจยังไม่เสถียร จึงใช้ค่าต่อเมื่อ SW=9000 และรูปแบบถูกต้อง มิฉะนั้นอ่านใหม่หลัง settle delay
+        self.last_read_cached = False
+        verify = None
+        cached = None
+        if self.card_cache is not None:
+            try:
+                cid = read_field('cid', require_ok=True)
+                request_number = (read_field('request_number', require_ok=True) or '').strip()
+                if cid and re.fullmatch(r'\d{13}', cid) and request_number:
+                    verify = (cid, request_number)
+                    cached = self.card_cache.get(*verify)
+                elif self.debug:
+                    print("[DEBUG] Cache verification read not usable, re-reading after settle delay")
+            except Exception as e:
+                if self.debug:
+                    print(f"[DEBUG] Cache verification read failed: {e}")
+                verify = None
+            if cached is not None:
+                cached.atr = atr
+                self.last_read_cached = True
+                if self.debug:
+                    print("[DEBUG] Card cache hit, skipping full read")
+                return cached
+
+        # Settle delay before heavy reads
+        if self.settle_delay > 0:
+            time.sleep(self.settle_delay)
+            if self.debug:
+                print(f"[DEBUG] Settled for {self.settle_delay}s before field reads")
+
+        record = CardRecord(
+            atr=atr,
+            cid=verify[0] if verify else read_field('cid'),
+            full_name_th=read_field('name_th').replace('#', ' ').strip(),
+            full_name_en=read_field('name_en').replace('#', ' ').strip(),
+            birth_raw=read_field('birth'),
+            gender_code=read_field('gender'),
+            issue_date_raw=read_field('issue_date'),
+            expire_date_raw=read_field('expire_date'),
+            issuer=read_field('issuer').strip(),
+            address=read_field('address').replace('#', ' ').strip(),
+        )
+        record.request_number = verify[1] if verify else read_field('request_number').strip()
 
         # รูปภาพ: พยายามอ่านหากกำหนดค่าเริ่มต้น offset ผ่าน ENV (PHOTO_START_OFFSET_HIGH/LOW)
         try:
-            data['photo'] = ''
             read_photo_flag = os.environ.get('READ_PHOTO', '1') == '1'
             if read_photo_flag:
                 photo_bytes = b''
@@ -323,7 +314,8 @@ class IDCardReader:
                 if os.environ.get('PHOTO_METHOD', 'parts') == 'parts':
                     if self.debug:
                         print("[DEBUG] Try photo read by predefined parts (main.py method)")
-                    photo_bytes = self.read_photo_by_parts(cardservice.connection)
+                    chunk_len = self.health.chunk_len() if self.health else 0xFF
+                    photo_bytes = self.read_photo_by_parts(cardservice.connection, chunk_len)
                 # 2) วิธีกำหนด offset
                 if not photo_bytes:
                     photo_high = os.environ.get('PHOTO_START_OFFSET_HIGH')
@@ -342,27 +334,40 @@ class IDCardReader:
                         if self.debug:
                             print(f"[DEBUG] Found JPEG header at H=0x{ph:02X} L=0x{pl:02X}")
                         photo_bytes = self.read_photo(cardservice.connection, ph, pl)
-                if photo_bytes:
-                    data['photo'] = base64.b64encode(photo_bytes).decode('ascii')
+                record.photo = photo_bytes or b''
         except Exception as e:
             if self.debug:
                 print(f"[DEBUG] อ่านรูปภาพไม่สำเร็จ: {e}")
-            data['photo'] = ''
+            record.photo = b''
 
-        return data
+        if self.card_cache is not None and record.cid:
+            self.card_cache.put(record.cid, record.request_number, record)
+        return record
+
+    def read_card_data_with_retry(self, attempts: int = None, delay: float = None, cardservice=None):
+        """พยายามอ่านข้อมูลบัตรซ้ำ หากเกิด error ชั่วคราว คืน dict (ดู read_record_with_retry)"""
+        return self.read_record_with_retry(attempts, delay, cardservice).to_dict()
+
+    def read_record_with_retry(self, attempts: int = None, delay: float = None, cardservice=None):
+        """พยายามอ่านข้อมูลบัตรซ้ำ หากเกิด error ชั่วคราว (เช่น SCARD communications error)
 
-    def read_card_data_with_retry(self, attempts: int, delay: float, cardservice):
-        """พยายามอ่านข้อมูลบัตรซ้ำ หากเกิด SCARD communications error"""
+        attempts: ค่าเริ่มต้น SMARTCARD_READ_ATTEMPTS; delay: None = backoff ตามสุขภาพเครื่องอ่าน
+        จำนวนครั้งที่ใช้จริงเก็บไว้ใน self.last_read_attempts
+        """
+        attempts = attempts or self.read_attempts
         last_err = None
         for i in range(1, attempts + 1):
+            self.last_read_attempts = i
             try:
-                return self.read_card_data(cardservice)
+                return self.read_record(cardservice)
             except Exception as e:
-                msg = str(e)
                 last_err = e
-                # หากพบ error การสื่อสารให้ retry ตามจำนวนที่กำหนด
-                if '0x8010002F' in msg or 'communications error' in msg.lower():
-                    time.sleep(delay)
+                # หากพบ error ชั่วคราวให้ retry ตามจำนวนที่กำหนด
+                if classify_error(e) in TRANSIENT_ERRORS and i < attempts:
+                    if delay is not None:
+                        time.sleep(delay)
+                    else:
+                        time.sleep(self.health.read_delay(i) if self.health else backoff_delay(i, 0.2, 2.0))
                     continue
                 else:
                     break
@@ -407,34 +412,21 @@ class IDCardReader:
             return bytes(data_acc)
         return b''
 
-    def read_photo_by_parts(self, connection):
-        """อ่านรูปภาพตามชุดคำสั่ง APDU ที่กำหนดไว้ล่วงหน้า (อิง main.py)"""
-        parts = [
-            [0x80, 0xB0, 0x01, 0x7B, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x02, 0x7A, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x03, 0x79, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x04, 0x78, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x05, 0x77, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x06, 0x76, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x07, 0x75, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x08, 0x74, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x09, 0x73, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x0A, 0x72, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x0B, 0x71, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x0C, 0x70, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x0D, 0x6F, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x0E, 0x6E, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x0F, 0x6D, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x10, 0x6C, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x11, 0x6B, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x12, 0x6A, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x13, 0x69, 0x02, 0x00, 0xFF],
-            [0x80, 0xB0, 0x14, 0x68, 0x02, 0x00, 0xFF],
-        ]
+    def read_photo_by_parts(self, connection, chunk_len: int = 0xFF):
+        """อ่านรูปภาพตามชุดคำสั่ง APDU ที่กำหนดไว้ล่วงหน้า (อิง main.py)
+
+        รูปอยู่ต่อเนื่องกันที่ offset 0x017B ยาว 20 x 0xFF ไบต์; chunk_len = 0xFF ได้ชุดคำสั่งเดิม 20 ส่วน
+        ค่าที่เล็กกว่าใช้กับเครื่องอ่านที่ส่งข้อมูลก้อนใหญ่ไม่เสถียร (ดู ReaderHealth)
+        """
+        start, total = 0x017B, 20 * 0xFF
+        parts = []
+        for offset in range(start, start + total, chunk_len):
+            length = min(chunk_len, start + total - offset)
+            parts.append([0x80, 0xB0, (offset >> 8) & 0xFF, offset & 0xFF, 0x02, 0x00, length])
         data_acc = bytearray()
         for idx, apdu in enumerate(parts, start=1):
             try:
-                resp, sw1, sw2 = self.send_apdu_with_get_response(connection, apdu)
+                resp, sw1, sw2 = self.apdu_retry(connection, apdu, self.field_retries)
             except Exception as e:
                 if self.debug:
                     print(f"[DEBUG] PHOTO parts transmit error at part {idx}: {e}")
@@ -445,7 +437,7 @@ class IDCardReader:
                 return b''
             data_acc.extend(resp)
             if self.debug:
-                print(f"[DEBUG] PHOTO part {idx}/20 size={len(resp)} total={len(data_acc)}")
+                print(f"[DEBUG] PHOTO part {idx}/{len(parts)} size={len(resp)} total={len(data_acc)}")
         # Validate JPEG
         if len(data_acc) > 4 and data_acc[0] == 0xFF and data_acc[1] == 0xD8:
             # If tail not exactly FFD9, still return; client can decode
@@ -481,35 +473,54 @@ class IDCardReader:
 
     # ------------------- Main Loop -------------------
     # ------------------- Event Producer Loop -------------------
+    def find_reader(self, target: str = None):
+        """คืนเครื่องอ่านที่ชื่อตรงกับ target (หรือเครื่องแรกหากไม่ระบุ) หรือ None"""
+        for r in readers():
+            if target is None or str(r) == target:
+                return r
+        return None
+
     def event_producer(self, loop, queue: asyncio.Queue, state: dict):
         """ตัวสร้างเหตุการณ์ตาม Flow ที่กำหนด เติมข้อความลงใน queue (thread)"""
+        self.run_events(lambda ev: loop.call_soon_threadsafe(queue.put_nowait, ev), state)
+
+    def run_events(self, emit, state: dict, target: str = None):
+        """วน Flow เครื่องอ่าน -> เสียบ -> อ่าน -> ถอด ส่งเหตุการณ์ผ่าน emit(event)
+
+        target: ชื่อเครื่องอ่านที่ต้องการเฝ้า (None = เครื่องแรกที่พบ) ใช้ในโหมด shard
+        """
         while True:
             # 1. ตรวจหาเครื่องอ่านบัตร (loop จนเจอ ส่งสถานะ not_found ทุกครั้งที่ยังไม่เจอ)
             reader_name = None
             while True:
+                self.alive_at = time.monotonic()
                 try:
-                    rlist = readers()
-                    if not rlist:
+                    reader = self.find_reader(target)
+                    if reader is None:
                         status_event = {
                             'type': 'reader_status',
                             'version': MESSAGE_VERSION,
                             'status': 'not_found',
                             'timestamp': time.time()
                         }
+                        if target is not None:
+                            status_event['reader_name'] = target
                         state['last_reader_status'] = status_event
-                        loop.call_soon_threadsafe(queue.put_nowait, status_event)
+                        emit(status_event)
                         time.sleep(2)
                         continue
-                    reader_name = str(rlist[0])
+                    reader_name = str(reader)
+                    self.health = self.health_for(reader_name)
                     status_event = {
                         'type': 'reader_status',
                         'version': MESSAGE_VERSION,
                         'status': 'found',
                         'reader_name': reader_name,
-                        'timestamp': time.time()
+                        'timestamp': time.time(),
+                        'health': self.health.snapshot()
                     }
                     state['last_reader_status'] = status_event
-                    loop.call_soon_threadsafe(queue.put_nowait, status_event)
+                    emit(status_event)
                     break
                 except Exception:
                     time.sleep(2)
@@ -517,13 +528,22 @@ class IDCardReader:
 
             # 2.1 Loop รอการเสียบบัตร (จะส่ง event เมื่อเสียบบัตร)
             while True:
+                self.alive_at = time.monotonic()
                 cardtype = AnyCardType()
-                cardrequest = CardRequest(timeout=1, cardType=cardtype)
+                if target is not None:
+                    cardrequest = CardRequest(timeout=1, cardType=cardtype, readers=[reader])
+                else:
+                    cardrequest = CardRequest(timeout=1, cardType=cardtype)
                 try:
                     cardservice = cardrequest.waitforcard()
+                    inserted_at = time.perf_counter()
+                    if self.batch_pipeline is not None and self._last_removed_at is not None:
+                        # เวลาที่เจ้าหน้าที่ใช้สลับบัตร (ถอด -> เสียบใบถัดไป)
+                        self.batch_pipeline.stats.add('swap', inserted_at - self._last_removed_at)
+                    self._last_removed_at = None
                     # 2.2 เจอบัตร -> แจ้งเหตุการณ์เสียบบัตร, อ่าน ส่งข้อมูล แล้วไปขั้นตอน 3
                     try:
-                        loop.call_soon_threadsafe(queue.put_nowait, {
+                        emit({
                             'type': 'card_inserted',
                             'version': MESSAGE_VERSION,
                             'reader_name': reader_name,
@@ -531,49 +551,70 @@ class IDCardReader:
                         })
                     except Exception:
                         pass
+                    health_before = self.health.snapshot()
+                    self.health.begin()
                     try:
-                        card_data = self.read_card_data_with_retry(attempts=3, delay=0.4, cardservice=cardservice)
-                        loop.call_soon_threadsafe(queue.put_nowait, {
+                        # ส่ง CardRecord ไปทั้งก้อน แปลงเป็น JSON เฉพาะที่ขอบ (broadcaster/sink)
+                        card_data = self.read_record_with_retry(cardservice=cardservice)
+                        self.health.record(True, time.perf_counter() - inserted_at, card_data.atr)
+                        data_event = {
                             'type': 'card_data',
                             'version': MESSAGE_VERSION,
                             'reader_name': reader_name,
                             'timestamp': time.time(),
                             'data': card_data
-                        })
+                        }
+                        if self.last_read_cached:
+                            data_event['cached'] = True
+                        emit(data_event)
+                        if self.batch_pipeline is not None:
+                            self.batch_pipeline.submit(data_event, inserted_at)
                     except Exception as e:
                         emsg = str(e)
-                        error_code = None
-                        if '0x8010002F' in emsg:
-                            error_code = 'SCARD_COMM_ERROR'
-                        elif '0x80100068' in emsg:
-                            error_code = 'SCARD_W_RESET_CARD'
-                        elif 'เลือก Applet' in emsg:
-                            error_code = 'APPLET_SELECT_FAILED'
+                        error_code = classify_error(e)
+                        self.health.record(False, time.perf_counter() - inserted_at, error_code=error_code)
                         if self.debug:
                             print(f"[DEBUG] Card read failure error_code={error_code} msg={emsg}")
-                        loop.call_soon_threadsafe(queue.put_nowait, {
+                        error_event = {
                             'type': 'error',
                             'version': MESSAGE_VERSION,
                             'reader_name': reader_name,
                             'timestamp': time.time(),
                             'message': f'อ่านบัตรไม่สำเร็จ: {e}',
                             'error_code': error_code,
-                            'retry_attempts': 3
-                        })
+                            'retry_attempts': self.last_read_attempts
+                        }
+                        emit(error_event)
+                        if self.batch_pipeline is not None:
+                            self.batch_pipeline.submit(error_event, inserted_at)
                     finally:
                         try:
                             cardservice.connection.disconnect()
                         except Exception:
                             pass
 
+                    # แจ้งสถานะเครื่องอ่านใหม่เมื่อสุขภาพหรือระดับ protocol/chunk เปลี่ยน
+                    health_after = self.health.snapshot()
+                    if (health_after['state'], health_after['level']) != (health_before['state'], health_before['level']):
+                        status_event = {
+                            'type': 'reader_status',
+                            'version': MESSAGE_VERSION,
+                            'status': 'found',
+                            'reader_name': reader_name,
+                            'timestamp': time.time(),
+                            'health': health_after
+                        }
+                        state['last_reader_status'] = status_event
+                        emit(status_event)
+
                     # 3 Loop เพื่อรอการถอดบัตร (ตรวจด้วยการลองเชื่อมต่อเครื่องอ่านแบบเบา ๆ)
                     while True:
+                        self.alive_at = time.monotonic()
                         try:
-                            rlist2 = readers()
-                            if not rlist2:
+                            reader2 = self.find_reader(target)
+                            if reader2 is None:
                                 # เครื่องอ่านหายไป ถือว่าเหมือนถอดบัตร
                                 raise NoCardException("reader not found")
-                            reader2 = rlist2[0]
                             conn = reader2.createConnection()
                             try:
                                 # พยายามเชื่อมต่อ หากไม่มีบัตรจะ error (เช่น SCARD_E_NO_SMARTCARD)
@@ -590,14 +631,15 @@ class IDCardReader:
                                     conn.disconnect()
                                 except Exception:
                                     pass
-                                time.sleep(0.5)
+                                time.sleep(self.removal_poll_interval)
                                 continue
                             except Exception as e_probe:
                                 # เชื่อมต่อไม่ได้ => ไม่มีบัตร
                                 if self.debug:
                                     print(f"[DEBUG] Removal detected by probe: {e_probe}")
+                                self._last_removed_at = time.perf_counter()
                                 try:
-                                    loop.call_soon_threadsafe(queue.put_nowait, {
+                                    emit({
                                         'type': 'card_removed',
                                         'version': MESSAGE_VERSION,
                                         'reader_name': reader_name,
@@ -608,8 +650,9 @@ class IDCardReader:
                                 break
                         except NoCardException:
                             # ไม่พบเครื่องอ่านหรือไม่มีบัตร
+                            self._last_removed_at = time.perf_counter()
                             try:
-                                loop.call_soon_threadsafe(queue.put_nowait, {
+                                emit({
                                     'type': 'card_removed',
                                     'version': MESSAGE_VERSION,
                                     'reader_name': reader_name,
@@ -622,7 +665,7 @@ class IDCardReader:
                             # ข้อผิดพลาดอื่น ๆ ให้พักแล้วตรวจใหม่เล็กน้อย
                             if self.debug:
                                 print(f"[DEBUG] Removal loop error: {e_unknown}")
-                            time.sleep(0.5)
+                            time.sleep(self.removal_poll_interval)
                             continue
                     # กลับไปเริ่มรอเสียบบัตรใหม่
                     continue
@@ -632,40 +675,1550 @@ class IDCardReader:
                 except Exception:
                     # ตรวจสอบว่าเครื่องอ่านยังอยู่ไหม ถ้าหาย -> กลับไปข้อ 1
                     try:
-                        if not readers():
+                        if self.find_reader(target) is None:
                             break  # กลับไปตรวจหาเครื่องอ่านใหม่
                     except Exception:
                         break
+                # ล้างรายการ cache ที่หมดอายุแม้ไม่มีบัตรเสียบ
+                if self.card_cache is not None:
+                    self.card_cache.purge()
                 # ให้ CPU พักเล็กน้อย
-                time.sleep(0.3)
+                time.sleep(self.insert_poll_interval)
 
             # 4 เครื่องอ่านหาย -> กลับไปข้อ 1
             # loop while True จะทำงานต่อ
             time.sleep(1)
 
 
+# ------------------- Card Record -------------------
+THAI_MONTHS = ['', 'มกราคม', 'กุมภาพันธ์', 'มีนาคม', 'เมษายน', 'พฤษภาคม', 'มิถุนายน',
+               'กรกฎาคม', 'สิงหาคม', 'กันยายน', 'ตุลาคม', 'พฤศจิกายน', 'ธันวาคม']
+
+ENG_MONTHS = ['', 'January', 'February', 'March', 'April', 'May', 'June',
+              'July', 'August', 'September', 'October', 'November', 'December']
+
+THAI_TITLES = {'จ.ต.','จ.ท.','จ.ส.ต.','จ.ส.ท.','จ.ส.อ.','จ.อ.','ด.ต.','น.ต.','น.ต. ...ร.น.','น.ท.','น.ท. ...ร.น.','น.อ.','น.อ. ...ร.น.','พ.จ.ต.','พ.จ.ท.','พ.จ.อ.','พ.ต.','พ.ต.ต.','พ.ต.ท.','พ.ต.อ.','พ.ท.','พ.อ.','พ.อ.ต.','พ.อ.ท.','พ.อ.อ.','พล.ต.','พล.ต.ต.','พล.ต.ท.','พล.ต.อ.','พล.ท.','พล.ร.ต.','พล.ร.ท.','พล.ร.อ.','พล.อ.','พล.อ.ต.','พล.อ.ท.','พล.อ.อ.','พลฯ','ม.ร.ว.','ม.ล.','ร.ต.','ร.ต. ...ร.น.','ร.ต.ต.','ร.ต.ท.','ร.ต.อ.','ร.ท.','ร.ท. ...ร.น.','ร.อ.','ร.อ. ...ร.น.','ส.ต.','ส.ต.ต.','ส.ต.ท.','ส.ต.อ.','ส.ท.','ส.อ.','นาย','นาง','นางสาว','น.ส.','เด็กชาย','ด.ช.','เด็กหญิง','ด.ญ.'}
+
+ENGLISH_TITLES = {'Mr.', 'Mrs.', 'Miss', 'Ms.', 'Master'}
+
+ADDRESS_PATTERNS = (
+    ('address_no', re.compile(r'^(\d+)')),
+    ('address_moo', re.compile(r'หมู่(?:ที่)?\s*(\d+)')),
+    ('address_tumbol', re.compile(r'ตำบล([^\s]+)')),
+    ('address_amphur', re.compile(r'อำเภอ([^\s]+)')),
+    ('address_province', re.compile(r'จังหวัด([^\s]+)')),
+)
+
+
+def parse_thai_date(date_str):
+    """แปลงวันที่จากรูปแบบ YYYYMMDD (พ.ศ.) เป็น (ไทย, อังกฤษ)"""
+    if date_str == '99999999':
+        return "ตลอดชีพ", "LIFELONG"
+    if len(date_str) == 8 and date_str.isdigit():
+        try:
+            thai_year = int(date_str[0:4])
+            month_int = int(date_str[4:6])
+            day = int(date_str[6:8])
+            if 1 <= month_int <= 12:
+                return (f"{day} {THAI_MONTHS[month_int]} {thai_year}",
+                        f"{day} {ENG_MONTHS[month_int]} {thai_year - 543}")
+        except Exception as e:
+            print(f"[ผิดพลาด] แปลงวันที่ไม่สำเร็จ: {e}")
+    return "ไม่ระบุ", "Not specified"
+
+
+def parse_person_name(full, titles):
+    """แยก (คำนำหน้า, ชื่อ, นามสกุล) จากชื่อเต็มที่คั่นด้วยช่องว่าง"""
+    parts = [p for p in full.split(' ') if p]
+    title = ''
+    first = ''
+    last = ''
+    if parts:
+        if parts[0] in titles:
+            title = parts[0]
+            remaining = parts[1:]
+        else:
+            remaining = parts
+        if remaining:
+            first = remaining[0]
+        if len(remaining) >= 2:
+            last = remaining[-1]
+    return title, first, last
+
+
+class CardRecord:
+    """ข้อมูลบัตรแบบมีชนิด (__slots__) สำหรับใช้ในโปรเซสเดียวกัน
+
+    เก็บเฉพาะข้อมูลดิบจากบัตรและรูปเป็น bytes; ชื่อที่แยกแล้ว วันที่ที่แปลงแล้ว และที่อยู่ย่อย
+    คำนวณครั้งแรกที่เรียกใช้แล้วเก็บไว้ to_dict() ให้ dict รูปแบบเดิม (รูปเป็น Base64) สำหรับ JSON/WebSocket
+    """
+
+    __slots__ = (
+        'atr', 'cid', 'full_name_th', 'full_name_en', 'birth_raw', 'gender_code',
+        'issue_date_raw', 'expire_date_raw', 'issuer', 'address', 'request_number', 'photo',
+        '_name_th', '_name_en', '_birth', '_issue', '_expire', '_address_parts',
+    )
+
+    RAW_FIELDS = ('atr', 'cid', 'full_name_th', 'full_name_en', 'birth_raw', 'gender_code',
+                  'issue_date_raw', 'expire_date_raw', 'issuer', 'address', 'request_number')
+
+    def __init__(self, atr='', cid='', full_name_th='', full_name_en='', birth_raw='', gender_code='',
+                 issue_date_raw='', expire_date_raw='', issuer='', address='', request_number='',
+                 photo=b''):
+        self.atr = atr
+        self.cid = cid
+        self.full_name_th = full_name_th
+        self.full_name_en = full_name_en
+        self.birth_raw = birth_raw
+        self.gender_code = gender_code
+        self.issue_date_raw = issue_date_raw
+        self.expire_date_raw = expire_date_raw
+        self.issuer = issuer
+        self.address = address
+        self.request_number = request_number
+        self.photo = photo
+        self._name_th = None
+        self._name_en = None
+        self._birth = None
+        self._issue = None
+        self._expire = None
+        self._address_parts = None
+
+    def __repr__(self):
+        return f"CardRecord(cid={self.cid!r}, full_name_en={self.full_name_en!r}, photo={len(self.photo)} bytes)"
+
+    # ---- ชื่อ ----
+    @property
+    def title_th(self):
+        return self._names_th()[0]
+
+    @property
+    def name_th(self):
+        return self._names_th()[1]
+
+    @property
+    def last_name_th(self):
+        return self._names_th()[2]
+
+    @property
+    def title_en(self):
+        return self._names_en()[0]
+
+    @property
+    def name_en(self):
+        return self._names_en()[1]
+
+    @property
+    def last_name_en(self):
+        return self._names_en()[2]
+
+    def _names_th(self):
+        if self._name_th is None:
+            self._name_th = parse_person_name(self.full_name_th, THAI_TITLES)
+        return self._name_th
+
+    def _names_en(self):
+        if self._name_en is None:
+            self._name_en = parse_person_name(self.full_name_en, ENGLISH_TITLES)
+        return self._name_en
+
+    # ---- วันที่ ----
+    @property
+    def birth_th(self):
+        return self._births()[0]
+
+    @property
+    def birth_en(self):
+        return self._births()[1]
+
+    @property
+    def issue_date_th(self):
+        return self._issues()[0]
+
+    @property
+    def issue_date_en(self):
+        return self._issues()[1]
+
+    @property
+    def expire_date_th(self):
+        return self._expires()[0]
+
+    @property
+    def expire_date_en(self):
+        return self._expires()[1]
+
+    @property
+    def birth_date(self):
+        """datetime.date (ค.ศ.) หรือ None"""
+        return self._to_date(self.birth_raw)
+
+    @property
+    def issue_date(self):
+        return self._to_date(self.issue_date_raw)
+
+    @property
+    def expire_date(self):
+        """None สำหรับบัตรตลอดชีพหรือวันที่ไม่ถูกต้อง"""
+        return self._to_date(self.expire_date_raw)
+
+    def _births(self):
+        if self._birth is None:
+            self._birth = parse_thai_date(self.birth_raw)
+        return self._birth
+
+    def _issues(self):
+        if self._issue is None:
+            self._issue = parse_thai_date(self.issue_date_raw)
+        return self._issue
+
+    def _expires(self):
+        if self._expire is None:
+            self._expire = parse_thai_date(self.expire_date_raw)
+        return self._expire
+
+    @staticmethod
+    def _to_date(raw):
+        try:
+            return datetime.date(int(raw[0:4]) - 543, int(raw[4:6]), int(raw[6:8]))
+        except (ValueError, TypeError):
+            return None
+
+    # ---- เพศ ----
+    @property
+    def gender_th(self):
+        return "ชาย" if self.gender_code == "1" else "หญิง" if self.gender_code == "2" else self.gender_code
+
+    @property
+    def gender_en(self):
+        return "Male" if self.gender_code == "1" else "Female" if self.gender_code == "2" else self.gender_code
+
+    # ---- ที่อยู่ ----
+    def address_parts(self) -> dict:
+        """แยกเลขที่/หมู่/ตำบล/อำเภอ/จังหวัด (รูปแบบที่อยู่ไทยทั่วไป)"""
+        if self._address_parts is None:
+            parts = {}
+            for key, pattern in ADDRESS_PATTERNS:
+                match = pattern.search(self.address)
+                parts[key] = match.group(1) if match else ''
+            self._address_parts = parts
+        return self._address_parts
+
+    @property
+    def address_no(self):
+        return self.address_parts()['address_no']
+
+    @property
+    def address_moo(self):
+        return self.address_parts()['address_moo']
+
+    @property
+    def address_tumbol(self):
+        return self.address_parts()['address_tumbol']
+
+    @property
+    def address_amphur(self):
+        return self.address_parts()['address_amphur']
+
+    @property
+    def address_province(self):
+        return self.address_parts()['address_province']
+
+    # ---- แปลงรูปแบบ ----
+    def to_dict(self, include_photo: bool = True) -> dict:
+        """dict รูปแบบเดียวกับ data ของเหตุการณ์ card_data (รูปเป็น Base64)"""
+        title_th, name_th, last_name_th = self._names_th()
+        title_en, name_en, last_name_en = self._names_en()
+        birth_th, birth_en = self._births()
+        issue_th, issue_en = self._issues()
+        expire_th, expire_en = self._expires()
+        data = {
+            'atr': self.atr,
+            'cid': self.cid,
+            'full_name_th': self.full_name_th,
+            'title_th': title_th,
+            'name_th': name_th,
+            'last_name_th': last_name_th,
+            'full_name_en': self.full_name_en,
+            'title_en': title_en,
+            'name_en': name_en,
+            'last_name_en': last_name_en,
+            'birth_raw': self.birth_raw,
+            'birth_th': birth_th,
+            'birth_en': birth_en,
+            'gender_th': self.gender_th,
+            'gender_en': self.gender_en,
+            'issue_date_raw': self.issue_date_raw,
+            'issue_date_th': issue_th,
+            'issue_date_en': issue_en,
+            'expire_date_raw': self.expire_date_raw,
+            'expire_date_th': expire_th,
+            'expire_date_en': expire_en,
+            'issuer': self.issuer,
+            'address': self.address,
+        }
+        data.update(self.address_parts())
+        data['request_number'] = self.request_number
+        if include_photo and self.photo:
+            data['photo'] = base64.b64encode(self.photo).decode('ascii')
+        else:
+            data['photo'] = ''
+        return data
+
+    def pack(self) -> bytes:
+        """รูปแบบไบต์กะทัดรัด (ข้อมูลดิบ JSON + รูปดิบ) ใช้กับ CardCache"""
+        head = json.dumps([getattr(self, f) for f in self.RAW_FIELDS], ensure_ascii=False).encode('utf-8')
+        return len(head).to_bytes(4, 'big') + head + bytes(self.photo)
+
+    @classmethod
+    def unpack(cls, blob: bytes) -> 'CardRecord':
+        size = int.from_bytes(blob[:4], 'big')
+        values = json.loads(blob[4:4 + size])
+        return cls(*values, photo=bytes(blob[4 + size:]))
+
+
+def json_default(obj):
+    """ใช้กับ json.dumps(default=...) เพื่อแปลง CardRecord เป็น dict ที่ขอบ WebSocket/ไฟล์"""
+    if isinstance(obj, CardRecord):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def event_data_dict(event: dict, include_photo: bool = True) -> dict:
+    """คืน data ของเหตุการณ์เป็น dict ไม่ว่าจะเป็น CardRecord หรือ dict"""
+    data = event.get('data')
+    if isinstance(data, CardRecord):
+        return data.to_dict(include_photo)
+    return data or {}
+
+
+# ------------------- Library API -------------------
+def read_card(reader_name: str = None, timeout: float = None, card_reader: IDCardReader = None,
+              cancel: threading.Event = None) -> CardRecord:
+    """อ่านบัตรหนึ่งใบภายในโปรเซส (ไม่ผ่าน WebSocket/JSON) แล้วคืน CardRecord
+
+    reader_name: ชื่อเครื่องอ่าน (None = เครื่องแรก); timeout: วินาทีที่รอเสียบบัตร (None = รอไม่จำกัด,
+    หมดเวลาจะ raise CardRequestTimeoutException); card_reader: ส่ง IDCardReader เดิมเข้ามาเพื่อใช้ cache/health ร่วมกัน
+    cancel: threading.Event ที่เมื่อ set จะหยุดรอเสียบบัตร (ตรวจทุก 1 วินาที) และ raise CardRequestTimeoutException
+    """
+    card_reader = card_reader or IDCardReader()
+    reader = card_reader.find_reader(reader_name)
+    if reader is None:
+        raise RuntimeError(f"ไม่พบเครื่องอ่านบัตร: {reader_name or '-'}")
+    card_reader.health = card_reader.health_for(str(reader))
+    # รอทีละช่วงสั้น ๆ เพื่อให้ยกเลิกได้ (thread ที่ค้างใน waitforcard จะไม่คืน slot ของ thread pool)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        if cancel is not None and cancel.is_set():
+            raise CardRequestTimeoutException('ยกเลิกการรอเสียบบัตร')
+        wait = 1.0 if deadline is None else min(1.0, deadline - time.monotonic())
+        if wait <= 0:
+            raise CardRequestTimeoutException('หมดเวลารอเสียบบัตร')
+        try:
+            cardservice = CardRequest(timeout=wait, cardType=AnyCardType(), readers=[reader]).waitforcard()
+            break
+        except CardRequestTimeoutException:
+            continue
+    started = time.perf_counter()
+    card_reader.health.begin()
+    try:
+        record = card_reader.read_record_with_retry(cardservice=cardservice)
+        card_reader.health.record(True, time.perf_counter() - started, record.atr)
+        return record
+    except Exception as e:
+        card_reader.health.record(False, time.perf_counter() - started, error_code=classify_error(e))
+        raise
+    finally:
+        try:
+            cardservice.connection.disconnect()
+        except Exception:
+            pass
+
+
+async def read_card_async(reader_name: str = None, timeout: float = None,
+                          card_reader: IDCardReader = None) -> CardRecord:
+    """read_card() แบบ async: งาน PC/SC ทำใน thread pool ไม่ block event loop
+
+    เมื่อ task ถูกยกเลิก thread จะหยุดรอเสียบบัตรภายใน ~1 วินาที (การอ่านที่เริ่มไปแล้วจะทำจนจบ)
+    """
+    cancel = threading.Event()
+    try:
+        return await asyncio.to_thread(read_card, reader_name, timeout, card_reader, cancel)
+    finally:
+        cancel.set()
+
+
+# ------------------- Reader Health -------------------
+SCARD_ERRORS = {
+    0x8010002F: 'SCARD_COMM_ERROR',
+    0x80100068: 'SCARD_W_RESET_CARD',
+    0x80100069: 'SCARD_W_REMOVED_CARD',
+    0x80100066: 'SCARD_W_UNRESPONSIVE_CARD',
+    0x80100067: 'SCARD_W_UNPOWERED_CARD',
+    0x8010000C: 'SCARD_E_NO_SMARTCARD',
+    0x8010000A: 'SCARD_E_TIMEOUT',
+    0x80100016: 'SCARD_E_NOT_TRANSACTED',
+    0x8010001D: 'SCARD_E_NO_SERVICE',
+    0x80100009: 'SCARD_E_UNKNOWN_READER',
+    0x8010000F: 'SCARD_E_PROTO_MISMATCH',
+}
+
+# error ที่ลองซ้ำแล้วมีโอกาสสำเร็จ (บัตร/เครื่องอ่านยังอยู่)
+TRANSIENT_ERRORS = {
+    'SCARD_COMM_ERROR', 'SCARD_W_RESET_CARD', 'SCARD_W_UNRESPONSIVE_CARD',
+    'SCARD_W_UNPOWERED_CARD', 'SCARD_E_TIMEOUT', 'SCARD_E_NOT_TRANSACTED',
+}
+
+PROTOCOLS = {
+    'T0|T1': SCARD_PROTOCOL_T0 | SCARD_PROTOCOL_T1,
+    'T1': SCARD_PROTOCOL_T1,
+    'T0': SCARD_PROTOCOL_T0,
+}
+PROTOCOL_NAMES = {v: k for k, v in PROTOCOLS.items()}
+
+# ลำดับการลดระดับเมื่อ error สูง: ขนาด chunk ของรูป (protocol คงเดิมตามที่บัตรเจรจาได้)
+HEALTH_LEVELS = [0xFF, 0x80, 0x40]
+
+
+def classify_error(e):
+    """คืนรหัส error (เช่น 'SCARD_COMM_ERROR') จาก hresult ของ pyscard หรือข้อความ; ไล่ดู __cause__ ด้วย"""
+    while e is not None:
+        hresult = getattr(e, 'hresult', None)
+        if isinstance(hresult, int) and (hresult & 0xFFFFFFFF) in SCARD_ERRORS:
+            return SCARD_ERRORS[hresult & 0xFFFFFFFF]
+        msg = str(e)
+        upper = msg.upper()
+        for code, name in SCARD_ERRORS.items():
+            if f'0X{code:08X}' in upper:
+                return name
+        if 'communications error' in msg.lower():
+            return 'SCARD_COMM_ERROR'
+        if 'เลือก Applet' in msg:
+            return 'APPLET_SELECT_FAILED'
+        e = e.__cause__
+    return None
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff แบบ equal jitter (attempt เริ่มที่ 1)"""
+    delay = min(cap, base * (2 ** (attempt - 1)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class ProtocolProfiles:
+    """จำ protocol ที่บัตรเจรจาได้และระดับ chunk ที่อ่านได้เสถียรต่อรุ่นเครื่องอ่าน + ATR (ใช้ร่วมกันทุก reader ใน process)"""
+
+    def __init__(self, downshift_rate: float = 0.3, retry_rate: float = 0.1, min_samples: int = 5,
+                 upshift_after: int = 50):
+        self.downshift_rate = downshift_rate
+        self.retry_rate = retry_rate
+        self.min_samples = min_samples
+        self.upshift_after = upshift_after
+        self.profiles = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(downshift_rate=float(os.environ.get('HEALTH_DOWNSHIFT_RATE', '0.3')),
+                   retry_rate=float(os.environ.get('HEALTH_DOWNSHIFT_RETRY_RATE', '0.1')),
+                   min_samples=int(os.environ.get('HEALTH_MIN_SAMPLES', '5')),
+                   upshift_after=int(os.environ.get('HEALTH_UPSHIFT_AFTER', '50')))
+
+    def _profile(self, model: str, atr: str) -> dict:
+        key = f'{model}|{atr}'
+        profile = self.profiles.get(key)
+        if profile is None:
+            profile = self.profiles[key] = {'level': 0, 'protocol': None, 'streak': 0, 'recent': deque(maxlen=20)}
+        return profile
+
+    def level(self, model: str, atr: str) -> int:
+        with self.lock:
+            return self._profile(model, atr)['level']
+
+    def protocol(self, model: str, atr: str) -> str:
+        """protocol ที่เคยเจรจาได้ ('T0'/'T1') หรือ 'T0|T1' หากยังไม่ทราบ"""
+        with self.lock:
+            return self._profile(model, atr)['protocol'] or 'T0|T1'
+
+    def remember_protocol(self, model: str, atr: str, protocol: str):
+        with self.lock:
+            self._profile(model, atr)['protocol'] = protocol
+
+    def record(self, model: str, atr: str, failed: bool, retries: int, apdus: int) -> int:
+        """บันทึกผลการอ่าน คืนระดับปัจจุบันหลังปรับ
+
+        ลดระดับเมื่อสัดส่วนการอ่านที่ล้มเหลวจริง (หลัง retry ครบ) หรือจำนวน retry ต่อ APDU ใน window สูงเกินเกณฑ์
+        retry ที่กู้คืนได้เพียงครั้งคราวจึงไม่ทำให้ลดระดับ
+        """
+        with self.lock:
+            profile = self._profile(model, atr)
+            profile['recent'].append((failed, retries, apdus))
+            profile['streak'] = profile['streak'] + 1 if not failed and not retries else 0
+            recent = profile['recent']
+            failure_rate = sum(1 for f, _, _ in recent if f) / len(recent)
+            retry_rate = sum(r for _, r, _ in recent) / max(1, sum(a for _, _, a in recent))
+            if (len(recent) >= self.min_samples and profile['level'] < len(HEALTH_LEVELS) - 1
+                    and (failure_rate >= self.downshift_rate or retry_rate >= self.retry_rate)):
+                profile['level'] += 1
+                profile['recent'].clear()
+                profile['streak'] = 0
+                print(f"[สุขภาพ] ลดระดับ {model} ATR={atr} -> chunk {HEALTH_LEVELS[profile['level']]}")
+            elif profile['level'] > 0 and profile['streak'] >= self.upshift_after:
+                # อ่านเสถียรต่อเนื่องนาน ลองกลับไประดับที่เร็วกว่า
+                profile['level'] -= 1
+                profile['recent'].clear()
+                profile['streak'] = 0
+                print(f"[สุขภาพ] เพิ่มระดับ {model} ATR={atr} -> chunk {HEALTH_LEVELS[profile['level']]}")
+            return profile['level']
+
+
+PROTOCOL_PROFILES = None
+
+
+def protocol_profiles() -> ProtocolProfiles:
+    global PROTOCOL_PROFILES
+    if PROTOCOL_PROFILES is None:
+        PROTOCOL_PROFILES = ProtocolProfiles.from_env()
+    return PROTOCOL_PROFILES
+
+
+class ReaderHealth:
+    """สุขภาพของเครื่องอ่านหนึ่งเครื่อง: อัตรา error/latency ใน sliding window, backoff และ protocol/chunk ที่ใช้"""
+
+    def __init__(self, reader_name: str, window: float = 300.0, apdu_backoff: float = 0.05,
+                 read_backoff: float = 0.2, backoff_cap: float = 2.0, profiles: ProtocolProfiles = None):
+        self.reader_name = reader_name
+        # ชื่อรุ่น: ตัดเลขลำดับท้ายชื่อ เช่น 'ACS ACR39U ICC Reader 0' -> 'ACS ACR39U ICC Reader'
+        self.model = re.sub(r'\s+\d+$', '', reader_name or '')
+        self.window = window
+        self.apdu_backoff = apdu_backoff
+        self.read_backoff = read_backoff
+        self.backoff_cap = backoff_cap
+        self.profiles = profiles or protocol_profiles()
+        self.samples = deque()  # (time, ok, latency, retries, apdus, error_code)
+        self.last_atr = ''
+        self.retries = 0  # APDU/read retry ของการอ่านครั้งปัจจุบัน
+        self.apdus = 0  # จำนวน APDU ของการอ่านครั้งปัจจุบัน (ไม่นับ retry)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, reader_name: str):
+        return cls(reader_name,
+                   window=float(os.environ.get('HEALTH_WINDOW', '300')),
+                   apdu_backoff=float(os.environ.get('HEALTH_APDU_BACKOFF', '0.05')),
+                   read_backoff=float(os.environ.get('HEALTH_READ_BACKOFF', '0.2')),
+                   backoff_cap=float(os.environ.get('HEALTH_BACKOFF_CAP', '2.0')))
+
+    # ---- ค่าที่ใช้ตอนอ่าน ----
+    @property
+    def level(self) -> int:
+        return self.profiles.level(self.model, self.last_atr)
+
+    def protocol(self, atr: str = None) -> int:
+        return PROTOCOLS[self.profiles.protocol(self.model, self.last_atr if atr is None else atr)]
+
+    def remember_protocol(self, atr: str, protocol: int):
+        """จำ protocol ที่เจรจาได้จริง (จาก getProtocol หลังเชื่อมต่อด้วย T0|T1)"""
+        name = PROTOCOL_NAMES.get(protocol)
+        if name in ('T0', 'T1'):
+            self.profiles.remember_protocol(self.model, atr, name)
+
+    def chunk_len(self) -> int:
+        return HEALTH_LEVELS[self.level]
+
+    def apdu_delay(self, attempt: int) -> float:
+        self.retries += 1
+        return backoff_delay(attempt, self._scaled(self.apdu_backoff), self.backoff_cap)
+
+    def read_delay(self, attempt: int) -> float:
+        self.retries += 1
+        return backoff_delay(attempt, self._scaled(self.read_backoff), self.backoff_cap)
+
+    def _scaled(self, base: float) -> float:
+        # อ่านล้มเหลวหรือต้อง retry ต่อ APDU มาก -> รอนานขึ้นก่อนลองใหม่ (สูงสุด 4 เท่า)
+        return base * (1 + 3 * min(1.0, max(self.error_rate(), self.retry_rate())))
+
+    # ---- บันทึกผล ----
+    def begin(self):
+        self.retries = 0
+        self.apdus = 0
+
+    def record(self, ok: bool, latency: float, atr: str = None, error_code: str = None):
+        if atr:
+            self.last_atr = atr
+        with self.lock:
+            self.samples.append((time.time(), ok, latency, self.retries, self.apdus, error_code))
+            self._trim()
+        # นับเฉพาะความล้มเหลวด้านการสื่อสาร (ไม่นับถอดบัตรระหว่างอ่าน ฯลฯ)
+        failed = not ok and error_code in TRANSIENT_ERRORS
+        self.profiles.record(self.model, self.last_atr, failed, self.retries, self.apdus)
+
+    def _trim(self):
+        cutoff = time.time() - self.window
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+
+    def error_rate(self) -> float:
+        """สัดส่วนการอ่านที่ล้มเหลวจริง (retry ที่กู้คืนได้ไม่นับ)"""
+        with self.lock:
+            self._trim()
+            if not self.samples:
+                return 0.0
+            return sum(1 for s in self.samples if not s[1]) / len(self.samples)
+
+    def retry_rate(self) -> float:
+        """จำนวน retry ต่อ APDU ใน window"""
+        with self.lock:
+            self._trim()
+            return sum(s[3] for s in self.samples) / max(1, sum(s[4] for s in self.samples))
+
+    def snapshot(self) -> dict:
+        rate = self.error_rate()
+        retry_rate = self.retry_rate()
+        with self.lock:
+            latencies = sorted(s[2] for s in self.samples if s[1])
+            failures = sum(1 for s in self.samples if not s[1])
+            reads = len(self.samples)
+        level = self.level
+        if rate >= 0.5:
+            state = 'failing'
+        elif rate >= 0.1 or retry_rate >= self.profiles.retry_rate:
+            # retry ที่กู้คืนได้ทำให้เป็น degraded ได้สูงสุด
+            state = 'degraded'
+        else:
+            state = 'healthy'
+        return {
+            'state': state,
+            'error_rate': round(rate, 3),
+            'retry_rate': round(retry_rate, 3),
+            'reads': reads,
+            'failures': failures,
+            'latency_ms_avg': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+            'latency_ms_p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1)
+            if latencies else None,
+            'protocol': self.profiles.protocol(self.model, self.last_atr),
+            'chunk_len': HEALTH_LEVELS[level],
+            'level': level,
+        }
+
+
+# ------------------- Card Cache -------------------
+class CardCache:
+    """Cache ข้อมูลบัตรในหน่วยความจำ อายุสั้น จำนวนจำกัด และเข้ารหัสไว้เสมอ
+
+    ใช้กับบัตรที่ถูกถอดแล้วเสียบกลับภายในไม่กี่วินาที: ตรวจด้วย cid + request_number แล้วคืนข้อมูลเดิม
+    คีย์เข้ารหัสสุ่มใหม่ทุกครั้งที่เริ่มโปรแกรมและไม่ถูกบันทึกที่ใด ใช้ AES-GCM หากมี cryptography
+    ไม่เช่นนั้นใช้ SHAKE-256 keystream + HMAC-SHA256 จาก stdlib
+    """
+
+    def __init__(self, ttl: float = 30.0, max_entries: int = 16):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # lookup key -> (expires_at, nonce, ciphertext, tag)
+        self.lock = threading.Lock()
+        self.lookup_key = os.urandom(32)
+        self.enc_key = os.urandom(32)
+        self.mac_key = os.urandom(32)
+        self.aead = AESGCM(self.enc_key) if AESGCM is not None else None
+
+    @classmethod
+    def from_env(cls):
+        if os.environ.get('CARD_CACHE', '0') != '1':
+            return None
+        return cls(ttl=float(os.environ.get('CARD_CACHE_TTL', '30')),
+                   max_entries=int(os.environ.get('CARD_CACHE_MAX', '16')))
+
+    def _lookup(self, cid: str, request_number: str) -> bytes:
+        # ไม่เก็บเลขบัตรเป็นคีย์ตรง ๆ
+        return hmac.new(self.lookup_key, f'{cid}|{request_number}'.encode('utf-8'), hashlib.sha256).digest()
+
+    def _encrypt(self, plaintext: bytes, aad: bytes):
+        nonce = os.urandom(12)
+        if self.aead is not None:
+            return nonce, self.aead.encrypt(nonce, plaintext, aad), b''
+        stream = hashlib.shake_256(self.enc_key + nonce).digest(len(plaintext))
+        ciphertext = (int.from_bytes(plaintext, 'big') ^ int.from_bytes(stream, 'big')).to_bytes(len(plaintext), 'big')
+        tag = hmac.new(self.mac_key, aad + nonce + ciphertext, hashlib.sha256).digest()
+        return nonce, ciphertext, tag
+
+    def _decrypt(self, nonce: bytes, ciphertext: bytes, tag: bytes, aad: bytes):
+        if self.aead is not None:
+            return self.aead.decrypt(nonce, ciphertext, aad)
+        expected = hmac.new(self.mac_key, aad + nonce + ciphertext, hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, tag):
+            raise ValueError('card cache entry failed authentication')
+        stream = hashlib.shake_256(self.enc_key + nonce).digest(len(ciphertext))
+        return (int.from_bytes(ciphertext, 'big') ^ int.from_bytes(stream, 'big')).to_bytes(len(ciphertext), 'big')
+
+    def put(self, cid: str, request_number: str, record: 'CardRecord'):
+        key = self._lookup(cid, request_number)
+        plaintext = record.pack()
+        nonce, ciphertext, tag = self._encrypt(plaintext, key)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, nonce, ciphertext, tag)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get(self, cid: str, request_number: str):
+        """คืน CardRecord ใหม่ (แก้ไขได้) หรือ None หากไม่มี/หมดอายุ"""
+        key = self._lookup(cid, request_number)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+        try:
+            return CardRecord.unpack(self._decrypt(entry[1], entry[2], entry[3], key))
+        except Exception:
+            with self.lock:
+                self.entries.pop(key, None)
+            return None
+
+    def purge(self):
+        """ลบรายการที่หมดอายุ"""
+        now = time.monotonic()
+        with self.lock:
+            for key in [k for k, e in self.entries.items() if e[0] <= now]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# ------------------- Batch Enrolment -------------------
+CSV_FIELDS = [
+    'timestamp', 'reader_name', 'cid', 'title_th', 'name_th', 'last_name_th', 'full_name_th',
+    'title_en', 'name_en', 'last_name_en', 'full_name_en', 'birth_raw', 'birth_th', 'birth_en',
+    'gender_th', 'gender_en', 'issue_date_raw', 'issue_date_th', 'issue_date_en',
+    'expire_date_raw', 'expire_date_th', 'expire_date_en', 'issuer', 'address', 'address_no',
+    'address_moo', 'address_tumbol', 'address_amphur', 'address_province', 'request_number',
+    'atr', 'photo'
+]
+
+
+class BatchStats:
+    """สถิติโหมด batch: จำนวนบัตรต่อนาที และ latency แยกตามขั้นตอน (thread-safe)"""
+
+    def __init__(self, window: int = 1000):
+        self.lock = threading.Lock()
+        self.window = window
+        self.stages = {}
+        self.completed = deque()  # เวลาที่บัตรแต่ละใบส่งออกครบ (ใช้คำนวณต่อนาที)
+        self.failed = deque()  # เวลาที่อ่านผิดพลาด (แยกจากบัตรที่สำเร็จ)
+        self.cards_total = 0
+        self.errors_total = 0
+        self.dropped = 0
+
+    def add(self, stage: str, seconds: float):
+        with self.lock:
+            samples = self.stages.get(stage)
+            if samples is None:
+                samples = self.stages[stage] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def card_done(self, ok: bool):
+        now = time.time()
+        with self.lock:
+            if ok:
+                self.cards_total += 1
+                self.completed.append(now)
+            else:
+                self.errors_total += 1
+                self.failed.append(now)
+            self._trim(now)
+
+    def drop(self):
+        with self.lock:
+            self.dropped += 1
+
+    def _trim(self, now: float):
+        for times in (self.completed, self.failed):
+            while times and times[0] < now - 60:
+                times.popleft()
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self.lock:
+            self._trim(now)
+            stages = {}
+            for name, samples in self.stages.items():
+                if not samples:
+                    continue
+                ordered = sorted(samples)
+                n = len(ordered)
+                stages[name] = {
+                    'count': n,
+                    'avg_ms': round(sum(ordered) / n * 1000, 1),
+                    'p50_ms': round(ordered[n // 2] * 1000, 1),
+                    'p95_ms': round(ordered[min(n - 1, int(n * 0.95))] * 1000, 1),
+                    'max_ms': round(ordered[-1] * 1000, 1),
+                }
+            return {
+                'cards_total': self.cards_total,
+                'errors_total': self.errors_total,
+                'cards_per_minute': len(self.completed),
+                'errors_per_minute': len(self.failed),
+                'dropped': self.dropped,
+                'stages': stages,
+            }
+
+
+class FileSink:
+    """เขียนผลลงไฟล์ (append) และ fsync เป็นชุดตามจำนวน/ช่วงเวลา"""
+
+    def __init__(self, path: str, fsync_every: int, fsync_interval: float):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.fh = open(path, 'a', encoding='utf-8', newline='')
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def write(self, event: dict, line: str):
+        """ค่าเริ่มต้น: หนึ่งบรรทัด JSON ต่อหนึ่งเหตุการณ์"""
+        self.fh.write(line)
+        self.fh.write('\n')
+        self.pending += 1
+
+    def flush(self):
+        """ส่ง buffer ให้ OS ทุกครั้งที่คิวว่าง; fsync เมื่อครบจำนวนหรือครบเวลา"""
+        self.fh.flush()
+        if self.pending and (self.pending >= self.fsync_every
+                             or time.monotonic() - self.last_sync >= self.fsync_interval):
+            os.fsync(self.fh.fileno())
+            self.pending = 0
+            self.last_sync = time.monotonic()
+
+    def close(self):
+        try:
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+        finally:
+            self.fh.close()
+
+
+class NDJSONSink(FileSink):
+    """หนึ่งบรรทัดต่อหนึ่งเหตุการณ์ (card_data และ error) ใช้ write ของ FileSink"""
+
+
+class CSVSink(FileSink):
+    """หนึ่งแถวต่อบัตรที่อ่านสำเร็จ (ข้าม error) คอลัมน์ตาม CSV_FIELDS"""
+
+    def __init__(self, path: str, fsync_every: int, fsync_interval: float):
+        super().__init__(path, fsync_every, fsync_interval)
+        self.include_photo = os.environ.get('BATCH_CSV_PHOTO', '0') == '1'
+        self.writer = csv.DictWriter(self.fh, fieldnames=CSV_FIELDS, extrasaction='ignore')
+        if self.fh.tell() == 0:
+            self.writer.writeheader()
+
+    def write(self, event: dict, line: str):
+        if event.get('type') != 'card_data':
+            return
+        row = dict(event_data_dict(event, self.include_photo))
+        row['timestamp'] = event.get('timestamp')
+        row['reader_name'] = event.get('reader_name')
+        if not self.include_photo:
+            row['photo'] = ''
+        self.writer.writerow(row)
+        self.pending += 1
+
+
+class SocketSink:
+    """ส่ง NDJSON ไปยัง TCP socket ภายในเครื่อง (sendall แบบ blocking = backpressure)
+
+    send_timeout: None = รอผู้รับได้ไม่จำกัด (ค่าเริ่มต้นจาก BATCH_SOCKET_SEND_TIMEOUT, 0 = ไม่จำกัด)
+    ระหว่างที่ socket ไม่ได้เชื่อมต่อ รายการที่เขียนจะถูกทิ้งและนับใน dropped
+    """
+
+    def __init__(self, host: str, port: int, reconnect_delay: float = 2.0, send_timeout: float = None):
+        self.host = host
+        self.port = port
+        self.reconnect_delay = reconnect_delay
+        if send_timeout is None:
+            send_timeout = float(os.environ.get('BATCH_SOCKET_SEND_TIMEOUT', '0')) or None
+        self.send_timeout = send_timeout
+        self.sock = None
+        self.next_connect = 0.0
+        self.dropped = 0
+
+    def _connect(self):
+        if time.monotonic() < self.next_connect:
+            return False
+        try:
+            self.sock = socket.create_connection((self.host, self.port), timeout=5)
+            # timeout 5 วินาทีใช้เฉพาะตอนเชื่อมต่อ; ตอนส่งให้ block ตามผู้รับ (backpressure)
+            self.sock.settimeout(self.send_timeout)
+            return True
+        except OSError as e:
+            print(f"[แบทช์] เชื่อมต่อ socket {self.host}:{self.port} ไม่สำเร็จ: {e}")
+            self.sock = None
+            self.next_connect = time.monotonic() + self.reconnect_delay
+            return False
+
+    def write(self, event: dict, line: str):
+        if self.sock is None and not self._connect():
+            self.dropped += 1
+            return
+        try:
+            self.sock.sendall(line.encode('utf-8') + b'\n')
+        except OSError as e:
+            print(f"[แบทช์] ส่งข้อมูลไป socket ไม่สำเร็จ: {e}")
+            self.dropped += 1
+            self.close()
+            self.next_connect = time.monotonic() + self.reconnect_delay
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+
+def build_sinks(spec: str, fsync_every: int, fsync_interval: float) -> list:
+    """สร้าง sink จากสตริง เช่น 'ndjson:reads.ndjson,csv:reads.csv,socket:127.0.0.1:9000'"""
+    sinks = []
+    for item in [p.strip() for p in spec.split(',') if p.strip()]:
+        kind, _, target = item.partition(':')
+        kind = kind.lower()
+        if kind == 'ndjson':
+            sinks.append(NDJSONSink(target, fsync_every, fsync_interval))
+        elif kind == 'csv':
+            sinks.append(CSVSink(target, fsync_every, fsync_interval))
+        elif kind == 'socket':
+            host, _, port = target.rpartition(':')
+            sinks.append(SocketSink(host or '127.0.0.1', int(port)))
+        else:
+            raise ValueError(f"ไม่รู้จักชนิด sink: {kind}")
+    return sinks
+
+
+class BatchPipeline:
+    """ส่งผลการอ่านไปยัง sinks ใน thread แยก เพื่อให้ thread อ่านบัตรรับใบถัดไปได้ทันที
+
+    คิวมีขนาดจำกัด: หาก sink ช้ากว่าการอ่าน submit() จะรอ (backpressure) แทนการกินหน่วยความจำ
+    """
+
+    def __init__(self, sinks: list, queue_size: int = 64, stats_interval: float = 10.0):
+        self.sinks = sinks
+        self.items = Queue(maxsize=queue_size)
+        self.stats = BatchStats()
+        self.stats_interval = stats_interval
+        self.emit = None
+        self.thread = None
+
+    @classmethod
+    def from_env(cls):
+        fsync_every = int(os.environ.get('BATCH_FSYNC_EVERY', '50'))
+        fsync_interval = float(os.environ.get('BATCH_FSYNC_INTERVAL', '1.0'))
+        sinks = build_sinks(os.environ.get('BATCH_SINKS', ''), fsync_every, fsync_interval)
+        return cls(sinks,
+                   queue_size=int(os.environ.get('BATCH_QUEUE_SIZE', '64')),
+                   stats_interval=float(os.environ.get('BATCH_STATS_INTERVAL', '10')))
+
+    def start(self, emit):
+        """emit: callable สำหรับส่งเหตุการณ์ batch_stats ไปยัง WebSocket"""
+        self.emit = emit
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, event: dict, inserted_at: float):
+        """เรียกจาก thread อ่านบัตร; inserted_at คือ time.perf_counter() ตอนพบบัตร"""
+        now = time.perf_counter()
+        self.stats.add('read', now - inserted_at)
+        item = (event, inserted_at, now)
+        try:
+            self.items.put_nowait(item)
+        except Full:
+            print(f"[แบทช์] คิวเต็ม ({self.items.maxsize}) รอ sink เขียนข้อมูล")
+            self.items.put(item)
+            self.stats.add('backpressure', time.perf_counter() - now)
+
+    def close(self):
+        if self.thread is not None:
+            self.items.put(None)
+            self.thread.join(timeout=5)
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                print(f"[แบทช์] ปิด sink ไม่สำเร็จ: {e}")
+
+    def _run(self):
+        next_stats = time.monotonic() + self.stats_interval
+        while True:
+            try:
+                item = self.items.get(timeout=0.5)
+            except Empty:
+                item = False
+            if item is None:
+                self._flush()
+                return
+            if item:
+                self._deliver(*item)
+            if self.items.empty():
+                self._flush()
+            if time.monotonic() >= next_stats:
+                next_stats = time.monotonic() + self.stats_interval
+                self._report()
+
+    def _deliver(self, event: dict, inserted_at: float, submitted_at: float):
+        started = time.perf_counter()
+        self.stats.add('queue', started - submitted_at)
+        line = json.dumps(event, ensure_ascii=False, default=json_default)
+        serialized = time.perf_counter()
+        self.stats.add('serialize', serialized - started)
+        for sink in self.sinks:
+            try:
+                sink.write(event, line)
+            except Exception as e:
+                self.stats.drop()
+                print(f"[แบทช์] เขียน sink ไม่สำเร็จ: {e}")
+        done = time.perf_counter()
+        self.stats.add('sink', done - serialized)
+        self.stats.add('total', done - inserted_at)
+        self.stats.card_done(event.get('type') == 'card_data')
+
+    def _flush(self):
+        for sink in self.sinks:
+            try:
+                sink.flush()
+            except Exception as e:
+                print(f"[แบทช์] flush sink ไม่สำเร็จ: {e}")
+
+    def _report(self):
+        snap = self.stats.snapshot()
+        snap['dropped'] += sum(getattr(s, 'dropped', 0) for s in self.sinks)
+        snap['queue_depth'] = self.items.qsize()
+        total = snap['stages'].get('total', {})
+        print(f"[แบทช์] {snap['cards_per_minute']} ใบ/นาที รวม {snap['cards_total']} ใบ "
+              f"ผิดพลาด {snap['errors_total']} ({snap['errors_per_minute']}/นาที) "
+              f"p95 {total.get('p95_ms', 0)} ms")
+        if self.emit is not None:
+            event = {
+                'type': 'batch_stats',
+                'version': MESSAGE_VERSION,
+                'timestamp': time.time(),
+            }
+            event.update(snap)
+            self.emit(event)
+
+
+# ------------------- Audit Store -------------------
+AUDIT_EVENT_TYPES = ('card_inserted', 'card_data', 'error', 'card_removed')
+
+AUDIT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    type TEXT NOT NULL,
+    reader_name TEXT,
+    cid TEXT,
+    error_code TEXT,
+    photo_hash TEXT,
+    payload TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS photos (
+    hash TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    first_seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_events_ts ON events(ts);
+CREATE INDEX IF NOT EXISTS idx_events_cid ON events(cid, ts);
+CREATE INDEX IF NOT EXISTS idx_events_reader ON events(reader_name, ts);
+CREATE INDEX IF NOT EXISTS idx_events_photo ON events(photo_hash);
+"""
+
+
+class AuditStore:
+    """บันทึกเหตุการณ์ลง SQLite (WAL) ผ่าน writer thread เดียว แบบ batch
+
+    record() ไม่แตะดิสก์: แค่ใส่คิว หากคิวเต็มจะทิ้งรายการและนับใน dropped
+    """
+
+    def __init__(self, path: str, retention_days: float = 90, batch_size: int = 500,
+                 flush_interval: float = 0.5, queue_size: int = 10000):
+        self.path = path
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.items = Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.thread = None
+        conn = self._connect()
+        try:
+            conn.executescript(AUDIT_SCHEMA)
+        finally:
+            conn.close()
+
+    @classmethod
+    def from_env(cls):
+        path = os.environ.get('AUDIT_DB', '').strip()
+        if not path:
+            return None
+        return cls(path,
+                   retention_days=float(os.environ.get('AUDIT_RETENTION_DAYS', '90')),
+                   batch_size=int(os.environ.get('AUDIT_BATCH_SIZE', '500')),
+                   flush_interval=float(os.environ.get('AUDIT_FLUSH_INTERVAL', '0.5')),
+                   queue_size=int(os.environ.get('AUDIT_QUEUE_SIZE', '10000')))
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def record(self, event: dict):
+        """เรียกจาก event loop ได้โดยไม่ block"""
+        if event.get('type') not in AUDIT_EVENT_TYPES:
+            return
+        try:
+            self.items.put_nowait(event)
+        except Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.thread is not None:
+            self.items.put(None)
+            self.thread.join(timeout=10)
+            self.thread = None
+
+    # ---- writer thread ----
+    def _run(self):
+        conn = self._connect()
+        next_prune = time.monotonic()
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                item = self.items.get(timeout=self.flush_interval)
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+            except Empty:
+                pass
+            # ดึงรายการที่ค้างอยู่ทั้งหมดเข้า transaction เดียว
+            while not stopping and len(batch) < self.batch_size:
+                try:
+                    item = self.items.get_nowait()
+                except Empty:
+                    break
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+            if batch:
+                try:
+                    self._write(conn, batch)
+                except Exception as e:
+                    self.dropped += len(batch)
+                    print(f"[บันทึก] เขียนฐานข้อมูลไม่สำเร็จ: {e}")
+            if self.retention_days > 0 and time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + 3600
+                try:
+                    self.prune(conn)
+                except Exception as e:
+                    print(f"[บันทึก] ลบข้อมูลเก่าไม่สำเร็จ: {e}")
+        conn.close()
+
+    def _write(self, conn, batch: list):
+        rows = []
+        photos = {}
+        for event in batch:
+            data = event.get('data') or {}
+            photo_hash = None
+            if isinstance(data, CardRecord):
+                # รูปดิบจาก CardRecord ไม่ต้องถอด Base64
+                photo = data.photo
+                data = data.to_dict(include_photo=False)
+                event = dict(event, data=data)
+            else:
+                photo = base64.b64decode(data['photo']) if data.get('photo') else b''
+                if photo:
+                    event = dict(event, data=dict(data, photo=''))
+            if photo:
+                photo_hash = hashlib.sha256(photo).hexdigest()
+                photos.setdefault(photo_hash, bytes(photo))
+            rows.append((
+                event.get('timestamp') or time.time(),
+                event['type'],
+                event.get('reader_name'),
+                data.get('cid') or None,
+                event.get('error_code'),
+                photo_hash,
+                json.dumps(event, ensure_ascii=False),
+            ))
+        now = time.time()
+        with conn:
+            if photos:
+                conn.executemany('INSERT OR IGNORE INTO photos (hash, data, first_seen) VALUES (?, ?, ?)',
+                                 [(h, p, now) for h, p in photos.items()])
+            conn.executemany('INSERT INTO events (ts, type, reader_name, cid, error_code, photo_hash, payload) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.written += len(rows)
+
+    def prune(self, conn=None):
+        """ลบเหตุการณ์ที่เก่ากว่า retention_days และรูปที่ไม่มีเหตุการณ์อ้างถึงแล้ว"""
+        own = conn is None
+        if own:
+            conn = self._connect()
+        try:
+            cutoff = time.time() - self.retention_days * 86400
+            with conn:
+                deleted = conn.execute('DELETE FROM events WHERE ts < ?', (cutoff,)).rowcount
+                if deleted:
+                    conn.execute('DELETE FROM photos WHERE NOT EXISTS '
+                                 '(SELECT 1 FROM events WHERE events.photo_hash = photos.hash)')
+            return deleted
+        finally:
+            if own:
+                conn.close()
+
+    # ---- query (เรียกจาก thread ใดก็ได้) ----
+    def recent_reads(self, limit: int = 20, cid: str = None, reader_name: str = None,
+                     since: float = None, types=('card_data',), include_photo: bool = False) -> list:
+        """คืนรายการเหตุการณ์ล่าสุด (ใหม่ -> เก่า) ตามเงื่อนไข"""
+        limit = max(1, min(int(limit), 1000))
+        if isinstance(types, str):
+            types = [types]
+        types = list(types or AUDIT_EVENT_TYPES)
+        unknown = [t for t in types if t not in AUDIT_EVENT_TYPES]
+        if unknown:
+            raise ValueError(f"types ไม่รองรับ: {unknown} (ใช้ได้: {', '.join(AUDIT_EVENT_TYPES)})")
+        clauses = [f"e.type IN ({','.join('?' * len(types))})"]
+        params = list(types)
+        if cid:
+            clauses.append('e.cid = ?')
+            params.append(cid)
+        if reader_name:
+            clauses.append('e.reader_name = ?')
+            params.append(reader_name)
+        if since is not None:
+            clauses.append('e.ts >= ?')
+            params.append(float(since))
+        photo_col = 'p.data' if include_photo else 'NULL'
+        sql = (f'SELECT e.id, e.payload, {photo_col} FROM events e '
+               'LEFT JOIN photos p ON p.hash = e.photo_hash '
+               f"WHERE {' AND '.join(clauses)} ORDER BY e.ts DESC LIMIT ?")
+        params.append(limit)
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            result = []
+            for row_id, payload, photo in conn.execute(sql, params):
+                event = json.loads(payload)
+                event['audit_id'] = row_id
+                if photo is not None and isinstance(event.get('data'), dict):
+                    event['data']['photo'] = base64.b64encode(photo).decode('ascii')
+                result.append(event)
+            return result
+        finally:
+            conn.close()
+
+
+# ------------------- Reader Sharding -------------------
+class ShardBatchProxy:
+    """แทน BatchPipeline ใน worker: ส่งผลและสถิติกลับไปให้ pipeline จริงใน front-end
+
+    เหตุการณ์ที่ run_events ส่งเข้า pipeline (EVENT_TYPES) ส่งผ่าน Pipe ครั้งเดียวเป็น ('batch', ...)
+    front-end จะ broadcast และเข้า pipeline จากข้อความเดียวกัน (ไม่ pickle รูปซ้ำสองครั้ง)
+    """
+
+    EVENT_TYPES = ('card_data', 'error')
+
+    def __init__(self, send):
+        self.send = send
+        self.stats = self
+
+    def add(self, stage: str, seconds: float):
+        self.send(('stat', stage, seconds))
+
+    def submit(self, event: dict, inserted_at: float):
+        # ส่งเป็นระยะเวลา เพราะ perf_counter ข้าม process เทียบกันไม่ได้
+        self.send(('batch', event, time.perf_counter() - inserted_at))
+
+
+def shard_worker(conn, reader_names: list, batch: bool, heartbeat: float, stall_timeout: float = 60.0):
+    """Process ลูก: หนึ่ง thread ต่อเครื่องอ่าน ส่งเหตุการณ์กลับผ่าน Pipe
+
+    ข้อความที่ส่ง: ('event', ev) / ('batch', ev, read_seconds) / ('stat', stage, seconds) / ('heartbeat',)
+    ส่ง heartbeat เฉพาะเมื่อทุก thread ยังทำงานและวน loop ภายใน stall_timeout วินาที
+    หาก thread ตายหรือค้างในคำสั่ง driver จะออกจาก process ทันทีเพื่อให้ supervisor restart
+    """
+    lock = threading.Lock()
+
+    def send(msg):
+        with lock:
+            conn.send(msg)
+
+    def emit(ev):
+        if batch and ev.get('type') in ShardBatchProxy.EVENT_TYPES:
+            return  # ส่งพร้อม ShardBatchProxy.submit
+        send(('event', ev))
+
+    workers = []
+    for name in reader_names:
+        reader = IDCardReader()
+        if batch:
+            reader.batch_pipeline = ShardBatchProxy(send)
+        thread = threading.Thread(target=reader.run_events,
+                                  args=(emit, {}, name),
+                                  daemon=True)
+        thread.start()
+        workers.append((name, reader, thread))
+    # thread หลัก: ส่ง heartbeat และออกเมื่อ front-end ปิด Pipe
+    while True:
+        try:
+            if conn.poll(heartbeat):
+                command = conn.recv()
+                if command == 'stop':
+                    break
+                if command == 'clear_cache':
+                    for _, reader, _ in workers:
+                        if reader.card_cache is not None:
+                            reader.card_cache.clear()
+                continue
+            now = time.monotonic()
+            for name, reader, thread in workers:
+                if not thread.is_alive():
+                    print(f"[shard] thread เครื่องอ่าน {name} หยุดทำงาน")
+                    os._exit(1)
+                if now - reader.alive_at > stall_timeout:
+                    print(f"[shard] เครื่องอ่าน {name} ค้างเกิน {stall_timeout:.0f} วินาที")
+                    os._exit(1)
+            send(('heartbeat',))
+        except (EOFError, OSError):
+            break
+    os._exit(0)
+
+
+class ShardSupervisor:
+    """รัน worker process ต่อเครื่องอ่าน/กลุ่มเครื่องอ่าน และ restart อัตโนมัติเมื่อ worker ตายหรือค้าง
+
+    groups: list ของ list ชื่อเครื่องอ่าน หากเป็น None จะสร้าง worker ต่อเครื่องอ่านที่ตรวจพบ (สแกนซ้ำเป็นระยะ)
+    """
+
+    def __init__(self, emit, state: dict, groups=None, pipeline=None,
+                 heartbeat: float = 2.0, heartbeat_timeout: float = 15.0, rescan_interval: float = 5.0,
+                 stall_timeout: float = 60.0):
+        self.emit = emit
+        self.state = state
+        self.groups = groups
+        self.pipeline = pipeline
+        self.heartbeat = heartbeat
+        self.heartbeat_timeout = heartbeat_timeout
+        self.rescan_interval = rescan_interval
+        self.stall_timeout = stall_timeout
+        self.covered = set()
+        self.conns = {}  # worker pid -> Pipe ของ worker ที่ทำงานอยู่
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, emit, state: dict, pipeline=None):
+        spec = os.environ.get('SHARD_READERS', '').strip()
+        groups = None
+        if spec:
+            # กลุ่มคั่นด้วย ';' เครื่องอ่านในกลุ่มคั่นด้วย '|'
+            groups = [[n.strip() for n in g.split('|') if n.strip()] for g in spec.split(';')]
+            groups = [g for g in groups if g]
+        return cls(emit, state, groups=groups, pipeline=pipeline,
+                   heartbeat=float(os.environ.get('SHARD_HEARTBEAT', '2')),
+                   heartbeat_timeout=float(os.environ.get('SHARD_HEARTBEAT_TIMEOUT', '15')),
+                   rescan_interval=float(os.environ.get('SHARD_RESCAN_INTERVAL', '5')),
+                   stall_timeout=float(os.environ.get('SHARD_STALL_TIMEOUT', '60')))
+
+    def start(self):
+        if self.groups is not None:
+            for group in self.groups:
+                self._spawn(group)
+        else:
+            threading.Thread(target=self._rescan_loop, daemon=True).start()
+
+    def _rescan_loop(self):
+        while True:
+            try:
+                names = [str(r) for r in readers()]
+            except Exception:
+                names = []
+            for name in names:
+                if name not in self.covered:
+                    self._spawn([name])
+            time.sleep(self.rescan_interval)
+
+    def _spawn(self, group: list):
+        with self.lock:
+            self.covered.update(group)
+        threading.Thread(target=self._supervise, args=(group,), daemon=True).start()
+
+    def _supervise(self, group: list):
+        """หนึ่ง thread ต่อ worker: รับข้อความ ส่งต่อ และ restart ด้วย backoff เมื่อ worker หลุด"""
+        backoff = 1.0
+        while True:
+            parent_conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(
+                target=shard_worker,
+                args=(child_conn, group, self.pipeline is not None, self.heartbeat, self.stall_timeout),
+                daemon=True
+            )
+            proc.start()
+            child_conn.close()  # ให้ recv() ได้ EOFError เมื่อ worker ตาย
+            with self.lock:
+                self.conns[proc.pid] = parent_conn
+            started = time.monotonic()
+            print(f"[shard] เริ่ม worker pid={proc.pid} เครื่องอ่าน={group}")
+            reason = self._pump(parent_conn)
+            with self.lock:
+                self.conns.pop(proc.pid, None)
+            try:
+                proc.terminate()
+            except Exception:
+                pass
+            proc.join(timeout=5)
+            parent_conn.close()
+            print(f"[shard] worker pid={proc.pid} หยุดทำงาน ({reason}) exitcode={proc.exitcode}")
+            for name in group:
+                self._forward({
+                    'type': 'reader_status',
+                    'version': MESSAGE_VERSION,
+                    'status': 'worker_restarting',
+                    'reader_name': name,
+                    'reason': reason,
+                    'timestamp': time.time()
+                })
+            if time.monotonic() - started > 60:
+                backoff = 1.0
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    def clear_card_cache(self):
+        """สั่งทุก worker ล้าง cache ข้อมูลบัตร"""
+        with self.lock:
+            conns = list(self.conns.values())
+        for conn in conns:
+            try:
+                conn.send('clear_cache')
+            except (OSError, ValueError):
+                pass
+
+    def _pump(self, conn) -> str:
+        while True:
+            try:
+                if not conn.poll(self.heartbeat_timeout):
+                    return 'heartbeat_timeout'
+                msg = conn.recv()
+            except (EOFError, OSError):
+                return 'exited'
+            kind = msg[0]
+            if kind == 'event':
+                self._forward(msg[1])
+            elif kind == 'batch':
+                self._forward(msg[1])
+                if self.pipeline is not None:
+                    self.pipeline.submit(msg[1], time.perf_counter() - msg[2])
+            elif kind == 'stat' and self.pipeline is not None:
+                self.pipeline.stats.add(msg[1], msg[2])
+
+    def _forward(self, event: dict):
+        if event.get('type') == 'reader_status':
+            self.state['last_reader_status'] = event
+            if event.get('reader_name'):
+                self.state.setdefault('reader_statuses', {})[event['reader_name']] = event
+        self.emit(event)
+
+
 # ------------------- WebSocket Server -------------------
 async def websocket_handler(websocket, clients, state):
     clients.add(websocket)
-    # ส่ง snapshot สถานะล่าสุดของเครื่องอ่านให้ client ใหม่ทันที
-    last_status = state.get('last_reader_status')
-    if last_status:
+    # ส่ง snapshot สถานะล่าสุดของเครื่องอ่านให้ client ใหม่ทันที (โหมด shard: ทุกเครื่อง)
+    statuses = list(state.get('reader_statuses', {}).values()) or [state.get('last_reader_status')]
+    for last_status in statuses:
+        if not last_status:
+            continue
         try:
             await websocket.send(json.dumps(last_status, ensure_ascii=False))
         except Exception:
             pass
     try:
-        await websocket.wait_closed()
+        # รับคำสั่งจาก client (JSON) จนกว่าการเชื่อมต่อจะปิด
+        async for message in websocket:
+            reply = await handle_command(message, state)
+            if reply is not None:
+                await websocket.send(json.dumps(reply, ensure_ascii=False))
+    except Exception:
+        pass
     finally:
-        clients.remove(websocket)
+        clients.discard(websocket)
 
 
-async def broadcaster(queue: asyncio.Queue, clients: set):
+async def handle_command(message, state):
+    """ประมวลผลคำสั่งจาก client คืนค่า dict สำหรับตอบกลับ (หรือ None)"""
+    try:
+        command = json.loads(message)
+        if not isinstance(command, dict):
+            raise ValueError('command must be a JSON object')
+    except Exception as e:
+        return {
+            'type': 'command_error',
+            'version': MESSAGE_VERSION,
+            'timestamp': time.time(),
+            'message': f'คำสั่งไม่ถูกต้อง: {e}'
+        }
+    ctype = command.get('type')
+    reply = {'version': MESSAGE_VERSION, 'request_id': command.get('request_id')}
+    if ctype == 'query_recent_reads':
+        audit = state.get('audit')
+        if audit is None:
+            reply.update(type='command_error', timestamp=time.time(),
+                         message='ไม่ได้เปิดใช้ audit store (AUDIT_DB)')
+            return reply
+        try:
+            reads = await asyncio.get_running_loop().run_in_executor(None, lambda: audit.recent_reads(
+                limit=command.get('limit', 20),
+                cid=command.get('cid'),
+                reader_name=command.get('reader_name'),
+                since=command.get('since'),
+                types=command.get('types') or ('card_data',),
+                include_photo=bool(command.get('include_photo', False))
+            ))
+        except Exception as e:
+            reply.update(type='command_error', timestamp=time.time(), message=f'ค้นหาไม่สำเร็จ: {e}')
+            return reply
+        reply.update(type='recent_reads', timestamp=time.time(), reads=reads)
+        return reply
+    if ctype == 'clear_card_cache':
+        clear = state.get('clear_card_cache')
+        if clear is None:
+            reply.update(type='command_error', timestamp=time.time(),
+                         message='ไม่ได้เปิดใช้ cache ข้อมูลบัตร (CARD_CACHE)')
+            return reply
+        clear()
+        reply.update(type='card_cache_cleared', timestamp=time.time())
+        return reply
+    reply.update(type='command_error', timestamp=time.time(), message=f'ไม่รู้จักคำสั่ง: {ctype}')
+    return reply
+
+
+async def broadcaster(queue: asyncio.Queue, clients: set, audit=None):
     while True:
         event = await queue.get()
+        if audit is not None:
+            audit.record(event)
         if not clients:
             continue
-        msg = json.dumps(event, ensure_ascii=False)
+        msg = json.dumps(event, ensure_ascii=False, default=json_default)
         to_remove = set()
         for ws in list(clients):
             try:
@@ -676,20 +2229,48 @@ async def broadcaster(queue: asyncio.Queue, clients: set):
             clients.discard(ws)
 
 
-async def main_async(host: str = '0.0.0.0', port: int = 8765):
+async def main_async(host: str = '0.0.0.0', port: int = 8765, producer=None):
+    """producer: callable(emit, state) ใช้แทนการอ่านบัตรจริง (เช่นแหล่งเหตุการณ์จำลองใน ws_loadtest.py)"""
     loop = asyncio.get_running_loop()
     queue: asyncio.Queue = asyncio.Queue()
     clients: set = set()
     state: dict = {'last_reader_status': None}
     reader = IDCardReader()
 
-    # เริ่ม thread สำหรับผลิต event
-    producer_thread = threading.Thread(target=reader.event_producer, args=(loop, queue, state), daemon=True)
-    producer_thread.start()
+    audit = AuditStore.from_env()
+    if audit is not None:
+        audit.start()
+        state['audit'] = audit
+        print(f"[บันทึก] บันทึกเหตุการณ์ลง {audit.path}")
+
+    pipeline = None
+    if os.environ.get('BATCH_MODE', '0') == '1':
+        pipeline = BatchPipeline.from_env()
+        pipeline.start(lambda ev: loop.call_soon_threadsafe(queue.put_nowait, ev))
+        reader.batch_pipeline = pipeline
+        print(f"[แบทช์] เปิดโหมด batch ส่งออก {len(pipeline.sinks)} sink")
+
+    if producer is not None:
+        threading.Thread(target=producer,
+                         args=(lambda ev: loop.call_soon_threadsafe(queue.put_nowait, ev), state),
+                         daemon=True).start()
+    elif os.environ.get('SHARD_MODE', '0') == '1':
+        # แยกเครื่องอ่านไปทำงานใน worker process; process นี้ทำหน้าที่ WebSocket อย่างเดียว
+        supervisor = ShardSupervisor.from_env(lambda ev: loop.call_soon_threadsafe(queue.put_nowait, ev),
+                                              state, pipeline=pipeline)
+        supervisor.start()
+        if os.environ.get('CARD_CACHE', '0') == '1':
+            state['clear_card_cache'] = supervisor.clear_card_cache
+    else:
+        if reader.card_cache is not None:
+            state['clear_card_cache'] = reader.card_cache.clear
+        # เริ่ม thread สำหรับผลิต event
+        producer_thread = threading.Thread(target=reader.event_producer, args=(loop, queue, state), daemon=True)
+        producer_thread.start()
 
     async with serve(lambda ws: websocket_handler(ws, clients, state), host, port):
         print(f"[WS] WebSocket server started on ws://{host}:{port}")
-        await broadcaster(queue, clients)
+        await broadcaster(queue, clients, audit)
 
 
 # ------------------- Tray App -------------------
@@ -772,6 +2353,8 @@ def tray_main():
 
 # ------------------- Main -------------------
 if __name__ == "__main__":
+    # จำเป็นสำหรับ worker process ของโหมด shard เมื่อ build เป็น .exe ด้วย PyInstaller
+    multiprocessing.freeze_support()
     # Ensure single instance via Windows named mutex
     ERROR_ALREADY_EXISTS = 183
     mutex_name = "Local\\ThaiSmartCardReader_Mutex"
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+# Copyright 2025 NOVELBIZ CO., LTD.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+
+# เปรียบเทียบ overhead ต่อบัตรและหน่วยความจำ: CardRecord (API ในโปรเซส) กับ dict + JSON (เส้นทาง WebSocket)
+# ใช้บัตรจำลองในหน่วยความจำ (ไม่มี latency ของ APDU) เพื่อวัดเฉพาะส่วนซอฟต์แวร์
+#
+#   python bench_record.py --iterations 2000 --retain 1000
+
+import argparse
+import gc
+import json
+import os
+import time
+import tracemalloc
+
+os.environ.setdefault('SMARTCARD_SETTLE_DELAY', '0')
+os.environ.setdefault('CARD_CACHE', '0')
+
+import ThaiSmartCardReader
+from ThaiSmartCardReader import CardRecord, IDCardReader, json_default
+
+
+class SimulatedConnection:
+    """ตอบ APDU READ BINARY จากข้อมูลบัตรตัวอย่าง (รูปขนาด 20 x 255 ไบต์ที่ offset 0x017B)"""
+
+    FIELDS = {
+        0x0004: '1234567890123',
+        0x0011: 'นาย#สมชาย##ใจดี',
+        0x0075: 'Mr.#Somchai##Jaidee',
+        0x00D9: '25300101',
+        0x00E1: '1',
+        0x00F6: 'กรมการปกครอง',
+        0x0167: '25650101',
+        0x016F: '25750101',
+        0x1579: '123#หมู่ที่ 2#ตำบลบางรัก#อำเภอบางรัก#จังหวัดกรุงเทพ',
+        0x1619: '12345678901234',
+    }
+
+    def __init__(self):
+        self.photo = b'\xff\xd8' + os.urandom(20 * 0xFF - 4) + b'\xff\xd9'
+
+    def connect(self, **kwargs):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def getATR(self):
+        return [0x3B, 0x67, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
+
+    def transmit(self, apdu):
+        if apdu[1] == 0xA4:
+            return [], 0x90, 0x00
+        offset, le = (apdu[2] << 8) | apdu[3], apdu[6]
+        if offset in self.FIELDS:
+            return list(self.FIELDS[offset].encode('tis-620').ljust(le, b' ')), 0x90, 0x00
+        if 0x017B <= offset < 0x017B + len(self.photo):
+            start = offset - 0x017B
+            return list(self.photo[start:start + le]), 0x90, 0x00
+        return [], 0x6A, 0x82
+
+
+class SimulatedService:
+    def __init__(self, connection):
+        self.connection = connection
+
+
+def dict_path(reader, service):
+    """เส้นทางเดิมของ service ภายนอก: dict -> JSON (server) -> dict (client)"""
+    event = {'type': 'card_data', 'version': '1.0', 'timestamp': time.time(),
+             'data': reader.read_card_data(service)}
+    return json.loads(json.dumps(event, ensure_ascii=False))['data']
+
+
+def record_path(reader, service):
+    return reader.read_record(service)
+
+
+def time_per_card(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def retained_bytes(make, count: int) -> int:
+    gc.collect()
+    tracemalloc.start()
+    items = [make() for _ in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CardRecord vs dict/JSON benchmark')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--retain', type=int, default=1000, help='จำนวนผลที่เก็บไว้เพื่อวัดหน่วยความจำ')
+    args = parser.parse_args(argv)
+
+    reader = IDCardReader()
+    service = SimulatedService(SimulatedConnection())
+    record = reader.read_record(service)
+    raw = {f: getattr(record, f) for f in CardRecord.RAW_FIELDS}
+    photo = record.photo
+
+    def build_dict():
+        event = {'type': 'card_data', 'data': CardRecord(photo=photo, **raw).to_dict()}
+        return json.loads(json.dumps(event, ensure_ascii=False))['data']
+
+    def build_record():
+        return CardRecord(photo=photo, **raw)
+
+    rows = [
+        ('read + dict/JSON (us/card)', time_per_card(lambda: dict_path(reader, service), args.iterations)),
+        ('read + CardRecord (us/card)', time_per_card(lambda: record_path(reader, service), args.iterations)),
+        ('build dict/JSON only (us/card)', time_per_card(build_dict, args.iterations)),
+        ('build CardRecord only (us/card)', time_per_card(build_record, args.iterations)),
+        ('CardRecord + 1 lazy field (us/card)', time_per_card(lambda: build_record().birth_date, args.iterations)),
+        ('CardRecord -> WS JSON (us/card)',
+         time_per_card(lambda: json.dumps({'data': build_record()}, ensure_ascii=False, default=json_default),
+                       args.iterations)),
+    ]
+    # วัดจากการอ่านจริง เพื่อให้ทุกผลมีสตริง/รูปเป็นของตัวเองเหมือนการใช้งานจริง
+    dict_mem = retained_bytes(lambda: dict_path(reader, service), args.retain)
+    record_mem = retained_bytes(lambda: record_path(reader, service), args.retain)
+    rows.append(('retained dict (bytes/card)', dict_mem / args.retain))
+    rows.append(('retained CardRecord (bytes/card)', record_mem / args.retain))
+
+    print(f"ThaiSmartCardReader benchmark iterations={args.iterations} retain={args.retain} "
+          f"photo={len(photo)}B ({ThaiSmartCardReader.__file__})")
+    for name, value in rows:
+        print(f"{name:<40} {value:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+# Copyright 2025 NOVELBIZ CO., LTD.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+
+# ทดสอบโหลด WebSocket fan-out (main_async + broadcaster) บน localhost
+# รัน server ใน process แยกด้วยแหล่งเหตุการณ์จำลอง แล้วเปิด client จำลองจำนวนมาก
+#
+#   python ws_loadtest.py --clients 200 --slow-fraction 0.1 --churn 20 --rates 1,10,50 --phase-seconds 10
+
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+from websockets import connect
+from websockets.exceptions import ConnectionClosed
+
+import ThaiSmartCardReader
+
+try:
+    import psutil
+except Exception:
+    psutil = None
+
+
+# ------------------- Synthetic Event Source -------------------
+class SyntheticEventSource:
+    """สร้างเหตุการณ์ card_data ตามอัตราที่กำหนดในแต่ละ phase แทนเครื่องอ่านจริง"""
+
+    def __init__(self, phases: list, photo_bytes: int, start_event):
+        self.phases = phases  # [(events_per_second, seconds), ...]
+        self.photo = base64.b64encode(b'\xff\xd8' + os.urandom(max(photo_bytes - 4, 0)) + b'\xff\xd9').decode('ascii')
+        self.start_event = start_event
+
+    def run(self, emit, state):
+        status = {
+            'type': 'reader_status',
+            'version': ThaiSmartCardReader.MESSAGE_VERSION,
+            'status': 'found',
+            'reader_name': 'Synthetic Reader',
+            'timestamp': time.time()
+        }
+        state['last_reader_status'] = status
+        emit(status)
+        self.start_event.wait()
+        seq = 0
+        for phase, (rate, seconds) in enumerate(self.phases):
+            t0 = time.perf_counter()
+            n = 0
+            while time.perf_counter() - t0 < seconds:
+                due = t0 + n / rate
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                emit({
+                    'type': 'card_data',
+                    'version': ThaiSmartCardReader.MESSAGE_VERSION,
+                    'reader_name': 'Synthetic Reader',
+                    'timestamp': time.time(),
+                    'loadtest': {'phase': phase, 'seq': seq},
+                    'data': {
+                        'cid': f'{seq:013d}',
+                        'full_name_th': 'นาย ทดสอบ ระบบ',
+                        'full_name_en': 'Mr. Test System',
+                        'photo': self.photo
+                    }
+                })
+                seq += 1
+                n += 1
+
+
+def server_main(port: int, phases: list, photo_bytes: int, start_event):
+    source = SyntheticEventSource(phases, photo_bytes, start_event)
+    asyncio.run(ThaiSmartCardReader.main_async('127.0.0.1', port, producer=source.run))
+
+
+# ------------------- Simulated Clients -------------------
+class Results:
+    def __init__(self, phase_count: int):
+        self.latency = [[] for _ in range(phase_count)]
+        self.slow_latency = [[] for _ in range(phase_count)]
+        self.received = [0] * phase_count
+        self.max_seq = [-1] * phase_count
+        self.min_seq = [None] * phase_count
+        self.dropped = [0] * phase_count
+        self.connect_errors = 0
+        self.churn_connects = 0
+        self.phase = -1
+
+
+async def steady_client(url: str, results: Results, slow_delay: float, stop: asyncio.Event):
+    samples = results.slow_latency if slow_delay else results.latency
+    try:
+        ws = await connect(url, max_size=None)
+    except Exception:
+        results.connect_errors += 1
+        return
+    try:
+        while not stop.is_set():
+            try:
+                msg = await asyncio.wait_for(ws.recv(), timeout=0.5)
+            except asyncio.TimeoutError:
+                continue
+            now = time.time()
+            event = json.loads(msg)
+            meta = event.get('loadtest')
+            if meta is None:
+                continue
+            phase = meta['phase']
+            samples[phase].append(now - event['timestamp'])
+            results.received[phase] += 1
+            results.max_seq[phase] = max(results.max_seq[phase], meta['seq'])
+            if results.min_seq[phase] is None or meta['seq'] < results.min_seq[phase]:
+                results.min_seq[phase] = meta['seq']
+            if slow_delay:
+                await asyncio.sleep(slow_delay)
+    except ConnectionClosed:
+        # server ตัดการเชื่อมต่อ client ที่ไม่ได้ขอปิด
+        if results.phase >= 0:
+            results.dropped[results.phase] += 1
+    finally:
+        await ws.close()
+
+
+async def churn_client(url: str, results: Results, interval: float, stop: asyncio.Event):
+    """เชื่อมต่อค้างไว้ interval วินาที (อ่านข้อความทิ้ง) ปิด แล้วพัก interval ก่อนเชื่อมต่อใหม่
+
+    อัตราการเชื่อมต่อจึงคงที่ ~1/(2*interval) ต่อ client ไม่ขึ้นกับความเร็วของ server
+    """
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        try:
+            async with connect(url, max_size=None) as ws:
+                results.churn_connects += 1
+                deadline = loop.time() + interval
+                while not stop.is_set():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        await asyncio.wait_for(ws.recv(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        break
+        except ConnectionClosed:
+            pass
+        except Exception:
+            results.connect_errors += 1
+        await asyncio.sleep(interval)
+
+
+async def sample_server(pid: int, results: Results, samples: list, stop: asyncio.Event):
+    """เก็บ CPU/หน่วยความจำของ server process (ต้องมี psutil)"""
+    if psutil is None:
+        return
+    proc = psutil.Process(pid)
+    proc.cpu_percent(None)
+    while not stop.is_set():
+        await asyncio.sleep(0.5)
+        try:
+            samples.append((results.phase, proc.cpu_percent(None), proc.memory_info().rss))
+        except psutil.Error:
+            return
+
+
+def percentile(values: list, pct: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct))] * 1000, 1)
+
+
+def summarize(args, phases: list, results: Results, server_samples: list) -> list:
+    report = []
+    steady = args.clients - int(args.clients * args.slow_fraction)
+    for i, (rate, seconds) in enumerate(phases):
+        lat = results.latency[i]
+        sent = results.max_seq[i] - results.min_seq[i] + 1 if results.min_seq[i] is not None else 0
+        cpu = [c for p, c, _ in server_samples if p == i]
+        rss = [r for p, _, r in server_samples if p == i]
+        report.append({
+            'phase': i,
+            'rate': rate,
+            'seconds': seconds,
+            'events_seen': sent,
+            'delivery_ratio': round(len(lat) / (sent * steady), 4) if sent and steady else None,
+            'p50_ms': percentile(lat, 0.50),
+            'p95_ms': percentile(lat, 0.95),
+            'p99_ms': percentile(lat, 0.99),
+            'max_ms': percentile(lat, 1.0),
+            'slow_p95_ms': percentile(results.slow_latency[i], 0.95),
+            'dropped_connections': results.dropped[i],
+            'server_cpu_avg': round(sum(cpu) / len(cpu), 1) if cpu else None,
+            'server_cpu_max': round(max(cpu), 1) if cpu else None,
+            'server_rss_max_mb': round(max(rss) / 1048576, 1) if rss else None,
+        })
+    return report
+
+
+async def run_clients(args, phases: list, pid: int, start_event) -> tuple:
+    url = f'ws://127.0.0.1:{args.port}'
+    results = Results(len(phases))
+    stop = asyncio.Event()
+    server_samples = []
+    slow = int(args.clients * args.slow_fraction)
+    tasks = []
+    for i in range(args.clients):
+        tasks.append(asyncio.create_task(steady_client(url, results, args.slow_delay if i < slow else 0, stop)))
+    for _ in range(args.churn):
+        tasks.append(asyncio.create_task(churn_client(url, results, args.churn_interval, stop)))
+    tasks.append(asyncio.create_task(sample_server(pid, results, server_samples, stop)))
+    await asyncio.sleep(args.warmup)
+    start_event.set()
+    for i, (_, seconds) in enumerate(phases):
+        results.phase = i
+        await asyncio.sleep(seconds)
+    # รอให้เหตุการณ์ที่ค้างอยู่ไปถึง client
+    await asyncio.sleep(args.drain)
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return results, server_samples
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='WebSocket fan-out load test (localhost)')
+    parser.add_argument('--clients', type=int, default=100, help='จำนวน client ที่เชื่อมต่อค้างไว้')
+    parser.add_argument('--slow-fraction', type=float, default=0.1, help='สัดส่วน client ที่อ่านช้า')
+    parser.add_argument('--slow-delay', type=float, default=0.5, help='หน่วงต่อข้อความของ client ช้า (วินาที)')
+    parser.add_argument('--churn', type=int, default=10, help='จำนวน client ที่เชื่อมต่อ/ตัดซ้ำ ๆ')
+    parser.add_argument('--churn-interval', type=float, default=0.5)
+    parser.add_argument('--rates', default='1,10,50', help='อัตราเหตุการณ์ต่อวินาทีของแต่ละ phase')
+    parser.add_argument('--phase-seconds', type=float, default=10)
+    parser.add_argument('--photo-bytes', type=int, default=6000, help='ขนาดรูป (ก่อน Base64)')
+    parser.add_argument('--port', type=int, default=0, help='0 = เลือกพอร์ตว่างอัตโนมัติ')
+    parser.add_argument('--warmup', type=float, default=2.0)
+    parser.add_argument('--drain', type=float, default=2.0)
+    parser.add_argument('--json', dest='json_path', help='บันทึกผลเป็นไฟล์ JSON')
+    parser.add_argument('--max-p95-ms', type=float, help='คืน exit code 1 หาก p95 ของ phase ใดเกินค่านี้')
+    args = parser.parse_args(argv)
+    if args.port == 0:
+        args.port = free_port()
+    phases = [(float(r), args.phase_seconds) for r in args.rates.split(',') if r.strip()]
+
+    start_event = multiprocessing.Event()
+    server = multiprocessing.Process(target=server_main,
+                                     args=(args.port, phases, args.photo_bytes, start_event),
+                                     daemon=True)
+    server.start()
+    try:
+        time.sleep(1.0)
+        results, server_samples = asyncio.run(run_clients(args, phases, server.pid, start_event))
+    finally:
+        server.terminate()
+        server.join(timeout=5)
+
+    report = summarize(args, phases, results, server_samples)
+    print(f"clients={args.clients} slow={int(args.clients * args.slow_fraction)} churn={args.churn} "
+          f"photo={args.photo_bytes}B churn_connects={results.churn_connects} connect_errors={results.connect_errors}")
+    if psutil is None:
+        print('(ไม่พบ psutil: ไม่วัด CPU/หน่วยความจำของ server)')
+    header = ['rate', 'events_seen', 'delivery_ratio', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms',
+              'slow_p95_ms', 'dropped_connections', 'server_cpu_avg', 'server_rss_max_mb']
+    print(' '.join(f'{h:>14}' for h in header))
+    for row in report:
+        print(' '.join(f'{str(row[h]):>14}' for h in header))
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as fh:
+            json.dump({'args': vars(args), 'phases': report}, fh, ensure_ascii=False, indent=2)
+    if args.max_p95_ms is not None:
+        if any(row['p95_ms'] is None or row['p95_ms'] > args.max_p95_ms for row in report):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())